@@ -1,18 +1,22 @@
+from tornado import gen
+
 from core.handlers import ApiHandler, PageHandler
 from core.decorators import check_params
+from core.utils.executor import run_in_executor
 from account.models import User
 
 
 class LoginApiHandler(ApiHandler):
     @check_params('userName', 'password')
+    @gen.coroutine
     def post(self, *args, **kwargs):
         user_name = self.get_str_argument('userName', '')
         password = self.get_str_argument('password', '')
         if not user_name or not password:
             return self.api_failed(4, '用户名/密码不正确')
         try:
-            user = User.auth_by_password(user_name, password)
-            session_id = self.generate_session(str(user.id), user.permissions, nickName=user.nickName)
+            user = yield run_in_executor(User.auth_by_password, user_name, password)
+            session_id = yield self.generate_session_async(str(user.id), user.permissions, nickName=user.nickName)
             return self.api_succeeded({'sessionId': session_id})
         except:
             return self.api_failed(4, '用户名/密码不正确')
@@ -29,8 +33,9 @@ class LoginPageHandler(PageHandler):
 
 
 class LogoutPageHandler(PageHandler):
+    @gen.coroutine
     def get(self, *args, **kwargs):
-        self.invalidate_session()
+        yield self.invalidate_session_async()
         return self.redirect('/')
 
 
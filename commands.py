@@ -2,6 +2,10 @@ import sys
 import config
 
 from account.models import User
+from core.models import BaseModel
+from core.utils import search_queue
+from library.models import Library
+from library.records import read_records, format_records
 
 
 def main():
@@ -9,6 +13,35 @@ def main():
     command = sys.argv[1]
     if command == 'user_clear_expired_uncompleted_bindings':
         User.clear_expired_uncompleted_bindings()
+    elif command == 'library_rebuild_patterns':
+        Library.rebuild_patterns()
+    elif command == 'library_pack_manuals':
+        Library.pack_manuals()
+    elif command == 'library_build_position_index':
+        Library.build_position_index()
+    elif command == 'library_rebuild_opening_stats':
+        Library.rebuild_opening_stats()
+    elif command == 'library_build_autocomplete':
+        Library.build_autocomplete()
+    elif command == 'library_import':
+        # library_import <user name> <record file>...
+        user = User.objects(userName=sys.argv[2]).get()
+        Library.bulk_import(user, read_records(sys.argv[3:]))
+    elif command == 'library_export':
+        # library_export <ndjson|txt|rif> <export file>
+        player_names = Library.export_player_names() if sys.argv[2] == 'rif' else ()
+        with open(sys.argv[3], 'w', encoding='utf-8') as file:
+            file.writelines(format_records(Library.export_records(), sys.argv[2], player_names))
+    elif command == 'search_reindex':
+        # search_reindex [replace_index]
+        Library.rebuild_search_index([Library], replace_index=sys.argv[2:] == ['replace_index'])
+    elif command == 'search_reconcile':
+        # search_reconcile [full]
+        Library.reconcile_search_index(full=sys.argv[2:] == ['full'])
+    elif command == 'search_queue_consume':
+        BaseModel.consume_search_queue()
+    elif command == 'search_queue_length':
+        print(search_queue.length())
     else:
         pass
 
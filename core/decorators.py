@@ -1,11 +1,26 @@
 from functools import wraps
 import time
 import logging
+from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
 from hashlib import md5
 
 import tornado.web
+from tornado import gen
+from tornado.concurrent import is_future
 from tornado.options import options
 
+from account.models import User
+from core.utils import cache
+from core.utils.executor import run_in_executor
+
+
+#
+# How long, in seconds, a missing page is locked for rendering, and how often the other requests check for it.
+#
+_PAGE_LOCK_EXPIRE_AFTER = 10
+_PAGE_LOCK_POLL_INTERVAL, _PAGE_LOCK_POLL_TIMES = 0.05, 40
+
 
 def measure(method_or_function):
     """Decorator that measures a method or function's time of execution.
@@ -26,9 +41,10 @@ def require_permissions(*required_permissions):
     """
     def decorator(method):
         @wraps(method)
+        @gen.coroutine
         def actual_decorator(handler, *args, **kwargs):
             # Check if the user is logged in.
-            session = handler.get_session()
+            session = yield handler.get_session_async()
             if not session:
                 return handler.on_login_required()
             # Check if the user has sufficient permissions.
@@ -37,7 +53,11 @@ def require_permissions(*required_permissions):
                 if required_permission not in own_permissions:
                     logging.warning('Insufficient permissions. ({0})'.format(handler.request.remote_ip))
                     raise tornado.web.HTTPError(403)
-            return method(handler, *args, **kwargs)
+            handler.current_user = User(id=session['userId'])
+            result = method(handler, *args, **kwargs)
+            if is_future(result):
+                result = yield result
+            return result
         return actual_decorator
     return decorator
 
@@ -70,3 +90,122 @@ def check_params(*extra_keys):
             return method(handler, *args, **kwargs)
         return actual_decorator
     return decorator
+
+
+def cache_page(*model_names, per_user=False):
+    """Decorator that caches the page rendered by a GET method until a document of the given models is saved or
+    deleted, see 'BaseModel.save_and_index'.
+
+    Pages are cached per route, arguments and permissions, and per user if the page shows the user's own data.
+    When a page is missing only one request renders it, the others wait for it to be cached.
+    """
+    def decorator(method):
+        @wraps(method)
+        @gen.coroutine
+        def actual_decorator(handler, *args, **kwargs):
+            session = yield handler.get_session_async()
+            permissions = _page_permissions(session, per_user)
+            arguments = md5(repr(sorted(handler.request.query_arguments.items())).encode('utf-8')).hexdigest()
+            try:
+                key, page, locked = yield run_in_executor(_find_cached_page, handler.request.path, model_names,
+                                                          permissions, arguments)
+                # Wait for the request rendering the page.
+                for _ in range(_PAGE_LOCK_POLL_TIMES if page is None and not locked else 0):
+                    yield gen.sleep(_PAGE_LOCK_POLL_INTERVAL)
+                    page = yield handler.get_cache_async(key)
+                    if page is not None:
+                        break
+            except:
+                logging.exception('Failed to read the page cache.')
+                key, page, locked = None, None, False
+            if page is not None:
+                return handler.finish(page)
+            handler.page_cache_key = key
+            try:
+                result = method(handler, *args, **kwargs)
+                if is_future(result):
+                    result = yield result
+                return result
+            finally:
+                if locked:
+                    run_in_executor(cache.release_lock, key)
+        return actual_decorator
+    return decorator
+
+
+def check_modified(get_version, per_user=False):
+    """Decorator that answers 304 to a GET when the browser has the current version of the page, before the page is
+    looked up in the cache or rendered.
+
+    'get_version' is called in the thread pool with the handler, and returns the version of the documents shown by
+    the page as (tag, update time in milliseconds or None), or None to always send the page. It should read as little
+    as possible, a projection or the generation counters, see 'generation_version'.
+    """
+    def decorator(method):
+        @wraps(method)
+        @gen.coroutine
+        def actual_decorator(handler, *args, **kwargs):
+            session = yield handler.get_session_async()
+            try:
+                version = yield run_in_executor(get_version, handler)
+            except:
+                logging.exception('Failed to read the page version.')
+                version = None
+            if version is not None and _is_not_modified(handler, version, _page_permissions(session, per_user)):
+                handler.set_status(304)
+                return handler.finish()
+            result = method(handler, *args, **kwargs)
+            if is_future(result):
+                result = yield result
+            return result
+        return actual_decorator
+    return decorator
+
+
+def generation_version(*model_names):
+    """Returns a 'check_modified' version function for pages showing documents of the given models, the page is
+    modified once one of them is saved or deleted.
+    """
+    def get_version(handler):
+        return '.'.join(cache.get_generations(*model_names)), None
+    return get_version
+
+
+def _page_permissions(session, per_user):
+    if not session:
+        return 'anonymous'
+    if per_user:
+        return '{0}:{1}'.format(','.join(sorted(session['permissions'])), session['userId'])
+    return ','.join(sorted(session['permissions']))
+
+
+def _is_not_modified(handler, version, permissions):
+    """Set the validators of a page, and returns whether the copy of the browser is still valid.
+
+    The ETag also depends on the permissions, as pages show different links to different users. Browsers send it
+    back whenever they have it, If-Modified-Since is only checked without it.
+    """
+    tag, update_time = version
+    handler.set_header('Etag', '"{0}"'.format(md5('{0}:{1}'.format(tag, permissions).encode('utf-8')).hexdigest()))
+    handler.set_header('Cache-Control', 'private, no-cache')
+    if update_time is not None:
+        handler.set_header('Last-Modified', datetime.utcfromtimestamp(update_time // 1000))
+    if handler.request.headers.get('If-None-Match'):
+        return handler.check_etag_header()
+    if_modified_since = handler.request.headers.get('If-Modified-Since')
+    if update_time is None or not if_modified_since:
+        return False
+    try:
+        return update_time // 1000 <= mktime_tz(parsedate_tz(if_modified_since))
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+
+def _find_cached_page(path, model_names, permissions, arguments):
+    """Returns the cache key of a page, the page if cached, and whether the page is locked for this request.
+    """
+    generations = '.'.join(cache.get_generations(*model_names))
+    key = 'page:{0}:{1}:{2}:{3}'.format(path, generations, permissions, arguments)
+    page = cache.get_cache(key)
+    locked = page is None and cache.acquire_lock(key, _PAGE_LOCK_EXPIRE_AFTER)
+    return key, page, locked
@@ -2,36 +2,70 @@ import re
 import json
 import time
 import logging
-from hashlib import md5
-from random import random
 from io import BytesIO
 from uuid import uuid4
 import os
+from collections import OrderedDict
+from threading import Lock
 
-import redis
 from tornado.options import options
 import tornado.web
+from tornado import gen
+from tornado.concurrent import Future
 from PIL import Image
 from mutagen import File as mutagenFile
 
 from account.models import User
 from core.decorators import require_login
 from core.utils.upload import upload_oss
+from core.utils.executor import run_in_executor
+from core.utils import cache
+from core.sessions import session_backend
 
 
 _int_pattern, _float_pattern = re.compile('^-?[0-9]+$'), re.compile('^-?[0-9]+(\.[0-9]+)?$')
 
-_redis_session_db_pool = redis.ConnectionPool(host=options.redis_session_db_host,
-                                              port=options.redis_session_db_port,
-                                              db=options.redis_session_db_database,
-                                              decode_responses=True,
-                                              socket_timeout=options.redis_session_db_timeout)
 
-_redis_cache_db_pool = redis.ConnectionPool(host=options.redis_cache_db_host,
-                                            port=options.redis_cache_db_port,
-                                            db=options.redis_cache_db_database,
-                                            decode_responses=True,
-                                            socket_timeout=options.redis_cache_db_timeout)
+class _SessionCache:
+    """A small in-process LRU cache of session data, shared by the requests handled by a process.
+
+    Entries expire after a few seconds, so a session invalidated by another process is only trusted that long.
+    """
+    def __init__(self, max_size, expire_after):
+        self.max_size = max_size
+        self.expire_after = expire_after
+        self.lock = Lock()
+        self.sessions = OrderedDict()
+
+    def get(self, session_id):
+        with self.lock:
+            expire_time, session = self.sessions.get(session_id, (0, None))
+            if expire_time < time.time():
+                self.sessions.pop(session_id, None)
+                return None
+            self.sessions.move_to_end(session_id)
+            return session
+
+    def set(self, session_id, session):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.sessions[session_id] = (time.time() + self.expire_after, session)
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+
+_session_cache = _SessionCache(options.session_cache_size, options.session_cache_expire_after)
+
+#
+# Marks the session of a request as not read yet, None meaning there is no session.
+#
+_SESSION_NOT_LOADED = object()
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -41,6 +75,10 @@ class BaseHandler(tornado.web.RequestHandler):
         # Ensure that we are getting the real IP.
         if 'X-Real-Ip' in self.request.headers:
             self.request.remote_ip = self.request.headers['X-Real-Ip']
+        # Set by the 'cache_page' decorator when the page being rendered should be cached.
+        self.page_cache_key = None
+        # The session is read at most once per request.
+        self.session = _SESSION_NOT_LOADED
 
     def get_str_argument(self, name, default='', strip=True):
         """Returns str value of the argument.
@@ -69,24 +107,17 @@ class BaseHandler(tornado.web.RequestHandler):
     def generate_session(self, user_id, permissions, **session_data):
         """Generate a new session and return the session ID.
         """
-        session_id = None
         session_data['userId'] = user_id
         session_data['permissions'] = permissions
-        session_data_str = json.dumps(session_data)
-        timestamp = hex(int(time.time()))[2:]
-        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
-        for retry_times in range(3):
-            if retry_times > 0:
-                logging.warning('Generated duplicate session ID, will try a new one.')
-            session_id = md5(str(user_id).encode('utf-8')).hexdigest()
-            session_id = '{1}{0}'.format(session_id, random())
-            session_id = md5(session_id.encode('utf-8')).hexdigest()
-            session_id = '{0}{1}'.format(session_id, random())
-            session_id = md5(session_id.encode('utf-8')).hexdigest()
-            session_id = '{0}{1}{2}'.format(timestamp, session_id[len(timestamp):len(session_id) - 1], retry_times)
-            if redis_client.set(session_id, session_data_str, ex=options.session_expire_after, nx=True):
-                break
-        return session_id if redis_client.get(session_id) == session_data_str else None
+        session_id = session_backend.generate(session_data)
+        if session_id:
+            _session_cache.set(session_id, session_data)
+        return session_id
+
+    def generate_session_async(self, user_id, permissions, **session_data):
+        """Coroutine version of the 'generate_session' method.
+        """
+        return run_in_executor(self.generate_session, user_id, permissions, **session_data)
 
     @property
     def language(self):
@@ -107,29 +138,57 @@ class BaseHandler(tornado.web.RequestHandler):
 
     def get_session(self):
         """Get session data.
+
+        The session is read once per request, from the in-process session cache if it was read recently.
         """
+        if self.session is not _SESSION_NOT_LOADED:
+            return self.session
         if not self.session_id:
+            self.session = None
             return None
-        try:
-            redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
-            session_data = redis_client.get(self.session_id)
-            return json.loads(session_data) if session_data else None
-        except:
-            return None
+        session = _session_cache.get(self.session_id)
+        if session is None:
+            try:
+                session = session_backend.get(self.session_id)
+            except:
+                return None
+            if session is not None:
+                _session_cache.set(self.session_id, session)
+        self.session = session
+        return session
+
+    def get_session_async(self):
+        """Coroutine version of the 'get_session' method, which only uses a thread if Redis has to be read.
+        """
+        if self.session is _SESSION_NOT_LOADED and self.session_id and _session_cache.get(self.session_id) is None:
+            return run_in_executor(self.get_session)
+        future = Future()
+        future.set_result(self.get_session())
+        return future
 
     def set_session(self, session_data):
         """Save session data.
         """
         if not self.session_id:
             return False
-        session_data_str = json.dumps(session_data)
-        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
-        return redis_client.set(self.session_id, session_data_str, ex=options.session_expire_after, xx=True)
+        if not session_backend.set(self.session_id, session_data):
+            return False
+        self.session = session_data
+        _session_cache.set(self.session_id, session_data)
+        return True
+
+    def set_session_async(self, session_data):
+        """Coroutine version of the 'set_session' method.
+        """
+        return run_in_executor(self.set_session, session_data)
 
     def get_current_user(self):
-        """Returns a fake user.
+        """Returns a fake user, if the session has already been read.
+
+        'render' reads the current user for the template namespace, which must not read the session on the IOLoop.
+        Handlers needing the user read the session with 'get_session_async' first, see 'require_permissions'.
         """
-        session = self.get_session()
+        session = self.session if self.session is not _SESSION_NOT_LOADED else None
         return User(id=session['userId']) if session else None
 
     def invalidate_session(self):
@@ -137,8 +196,14 @@ class BaseHandler(tornado.web.RequestHandler):
         """
         if not self.session_id:
             return
-        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
-        redis_client.delete(self.session_id)
+        self.session = None
+        _session_cache.delete(self.session_id)
+        session_backend.invalidate(self.session_id)
+
+    def invalidate_session_async(self):
+        """Coroutine version of the 'invalidate_session' method.
+        """
+        return run_in_executor(self.invalidate_session)
 
     @property
     def session_id(self):
@@ -154,14 +219,29 @@ class BaseHandler(tornado.web.RequestHandler):
     def get_cache(self, key):
         """Get cached value.
         """
-        redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
-        return redis_client.get(key)
+        return cache.get_cache(key)
+
+    def get_cache_async(self, key):
+        """Coroutine version of the 'get_cache' method.
+        """
+        return run_in_executor(self.get_cache, key)
 
     def set_cache(self, key, value, ex=None):
         """Set cache value.
         """
-        redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
-        return redis_client.set(key, value, ex=ex)
+        return cache.set_cache(key, value, ex=ex)
+
+    def set_cache_async(self, key, value, ex=None):
+        """Coroutine version of the 'set_cache' method.
+        """
+        return run_in_executor(self.set_cache, key, value, ex=ex)
+
+    def finish(self, chunk=None):
+        """Also store the page in the page cache if the 'cache_page' decorator asked for it.
+        """
+        if self.page_cache_key and chunk is not None and self.get_status() == 200:
+            run_in_executor(cache.set_cache, self.page_cache_key, chunk, ex=options.page_cache_expire_after)
+        return super().finish(chunk)
 
 
 class PageHandler(BaseHandler):
@@ -253,6 +333,7 @@ class UploadImageHandler(ApiHandler):
     """Upload image, only GIF, JPEG and PNG formats are allowed.
     """
     @require_login
+    @gen.coroutine
     def post(self, *args, **kwargs):
         contents = self.request.files['file'][0]['body']
         if len(contents) > options.upload_image_max_length:
@@ -260,7 +341,7 @@ class UploadImageHandler(ApiHandler):
         with Image.open(BytesIO(contents)) as image:
             if image.format not in options.upload_image_accept_formats:
                 return self.api_failed(4, 'Invalid image format.')
-            url = upload_oss(contents, image.format)
+            url = yield run_in_executor(upload_oss, contents, image.format)
             return self.api_succeeded({'url': url, 'width': image.width, 'height': image.height})
 
 
@@ -268,6 +349,7 @@ class UploadAudioHandler(ApiHandler):
     """Upload audio, only MP3 format is allowed.
     """
     @require_login
+    @gen.coroutine
     def post(self, *args, **kwargs):
         contents = self.request.files['file'][0]['body']
         if len(contents) > options.upload_audio_max_length:
@@ -275,7 +357,7 @@ class UploadAudioHandler(ApiHandler):
         audio = mutagenFile(BytesIO(contents))
         if audio.mime[0] not in options.upload_audio_accept_formats:
             return self.api_failed(4, 'Invalid audio format.')
-        url = upload_oss(contents, audio.mime[0].split('/')[1])
+        url = yield run_in_executor(upload_oss, contents, audio.mime[0].split('/')[1])
         return self.api_succeeded({'url': url, 'duration': int(audio.info.length)})
 
 
@@ -283,6 +365,7 @@ class UploadVideoHandler(ApiHandler):
     """Upload video, only MP4 format is allowed.
     """
     @require_login
+    @gen.coroutine
     def post(self, *args, **kwargs):
         # Video
         video_contents = self.request.files['file'][0]['body']
@@ -294,11 +377,12 @@ class UploadVideoHandler(ApiHandler):
         video_extension = video_info.mime[0].split('/')[1]
         # Cover image
         video_duration = int(video_info.info.length)
-        cover_contents, cover_extension = self.capture(video_contents, video_extension, video_duration)
+        cover_contents, cover_extension = yield run_in_executor(self.capture, video_contents, video_extension,
+                                                                video_duration)
         # Do upload video and cover image
-        video_url = upload_oss(video_contents, video_extension)
+        video_url = yield run_in_executor(upload_oss, video_contents, video_extension)
         with Image.open(BytesIO(cover_contents)) as cover:
-            cover_url = upload_oss(cover_contents, cover_extension)
+            cover_url = yield run_in_executor(upload_oss, cover_contents, cover_extension)
             return self.api_succeeded({'url': video_url, 'duration': video_duration,
                                        'cover': {'url': cover_url, 'width': cover.width, 'height': cover.height}})
 
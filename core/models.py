@@ -1,13 +1,26 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
+import struct
 import logging
 import math
+import json
+import importlib
+from hashlib import md5
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
 
-from mongoengine import connect, Document
+from bson import ObjectId
+from mongoengine import connect, Document, Q
 from tornado.options import options
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch.helpers import bulk, parallel_bulk, scan
 from mongoengine.fields import ReferenceField, DateTimeField, EmbeddedDocument, EmbeddedDocumentField, IntField,\
     URLField
 
+from core.utils.executor import run_in_executor
+from core.utils.cache import get_cache, set_cache, get_generations, increase_generation
+from core.utils import search_queue
+
 
 connect(options.mongo_db_database,
         host=options.mongo_db_host,
@@ -19,11 +32,36 @@ connect(options.mongo_db_database,
 # a single global instance of the client and use it throughout your application. If your application is
 # long-running consider turning on Sniffing to make sure the client is up to date on the cluster location.
 #
+# 'options.elasticsearch_index' is an alias pointing to a versioned index, see 'BaseModel.rebuild_search_index'.
+#
 _elasticsearch = Elasticsearch(options.elasticsearch_hosts,
                                sniff_on_start=False,
                                sniff_on_connection_fail=True,
                                sniffer_timeout=options.elasticsearch_timeout)
 
+#
+# Longest wait, in seconds, before retrying search index operations which failed because elasticsearch or MongoDB
+# is not available.
+#
+_SEARCH_QUEUE_MAX_BACKOFF = 60
+
+#
+# Documents updated this many milliseconds before the reconciliation watermark are checked again, in case they were
+# being saved while the previous reconciliation ran.
+#
+_RECONCILIATION_OVERLAP = 60 * 1000
+
+#
+# A page cursor holds the update time in milliseconds and the ID of the last document of the previous page.
+#
+_PAGE_CURSOR = struct.Struct('<q12s')
+
+
+class OutdatedDocument(Exception):
+    """Raised by a consistent update when the document has been updated or deleted since it was read.
+    """
+    pass
+
 
 class BaseModel(Document):
     """Base class for MongoDB models.
@@ -68,27 +106,76 @@ class BaseModel(Document):
                 raise Exception('The {0} being updated does not exist.'.format(cls))
             instance = cls.objects.get(id=id)
         else:
-            # Consistent update.
-            if cls.objects(id=id, updateBy=user, updateTime=old_update_time).\
-                    update_one(upsert=False, updateTime=now, **attributes) == 0:
-                raise Exception('The {0} being updated does not exist or is out dated.'.format(cls))
+            # Consistent update, only if nobody has updated the document since it was read.
+            if cls.objects(id=id, updateTime=old_update_time).\
+                    update_one(upsert=False, updateBy=user, updateTime=now, **attributes) == 0:
+                raise OutdatedDocument('The {0} being updated does not exist or is out dated.'.format(cls))
             instance = cls.objects.get(id=id)
         # Index the instance if necessary.
-        instance.index_for_search()
+        instance.queue_for_search()
+        # Outdate the cached pages showing instances of this class.
+        increase_generation(cls.__name__)
         return instance
 
+    @classmethod
+    def save_and_index_async(cls, *args, **kwargs):
+        """Coroutine version of the 'save_and_index' method.
+        """
+        return run_in_executor(cls.save_and_index, *args, **kwargs)
+
     @staticmethod
     def paginate_query_set(query_set, page_num, page_size):
-        """Paginate a mongoengine query set.
+        """Paginate a mongoengine query set, the documents of the page are fetched before returning.
         """
         page_num, page_count = BaseModel.__calc_page_num_and_page_count(query_set.count(), page_num, page_size)
-        return query_set[page_size * page_num: page_size * (page_num + 1)], page_num, page_count
+        return list(query_set[page_size * page_num: page_size * (page_num + 1)]), page_num, page_count
+
+    @staticmethod
+    def paginate_query_set_async(query_set, page_num, page_size):
+        """Coroutine version of the 'paginate_query_set' method.
+        """
+        return run_in_executor(BaseModel.paginate_query_set, query_set, page_num, page_size)
+
+    @staticmethod
+    def paginate_query_set_by_cursor(query_set, cursor, page_size):
+        """Paginate a mongoengine query set by update time and ID in descending order, with opaque cursors.
+
+        Unlike 'paginate_query_set', no count and no skip are needed, so a deep page is as fast as the first one.
+        Returns the documents of the page, and the cursor of the next page or None on the last page.
+        """
+        after = BaseModel.decode_page_cursor(cursor)
+        if after:
+            update_time, id = from_milliseconds(after[0]), after[1]
+            query_set = query_set.filter(Q(updateTime__lt=update_time) | Q(updateTime=update_time, id__lt=id))
+        documents = list(query_set.order_by('-updateTime', '-id').limit(page_size + 1))
+        if len(documents) <= page_size:
+            return documents, None
+        last_document = documents[page_size - 1]
+        return documents[:page_size], BaseModel.encode_page_cursor(to_milliseconds(last_document.updateTime),
+                                                                   last_document.id)
+
+    @staticmethod
+    def encode_page_cursor(update_time, id):
+        """Returns the cursor of the page after the given update time in milliseconds and ID.
+        """
+        return urlsafe_b64encode(_PAGE_CURSOR.pack(update_time, ObjectId(id).binary)).decode('ascii')
+
+    @staticmethod
+    def decode_page_cursor(cursor):
+        """Returns the update time in milliseconds and the ID in a cursor, or None if the cursor is empty or invalid.
+        """
+        try:
+            update_time, id = _PAGE_CURSOR.unpack(urlsafe_b64decode(cursor.encode('ascii')))
+            return update_time, ObjectId(id)
+        except (Base64Error, UnicodeEncodeError, struct.error):
+            return None
 
     def delete(self, **write_concern):
         """Delete a document from MongoDB, also delete it from elasticsearch if necessary.
         """
         super().delete(**write_concern)
-        self.__class__.delete_index(self.id)
+        self.queue_for_search('delete')
+        increase_generation(self.__class__.__name__)
 
     def index_for_search(self):
         """Index a MongoDB document for elasticsearch if necessary.
@@ -108,28 +195,296 @@ class BaseModel(Document):
             logging.error('Failed to index {{class={0}.{1}, id={2}}} for search.'.
                           format(self.__class__.__module__, self.__class__.__name__, self.id))
 
+    def queue_for_search(self, operation='index'):
+        """Queue an 'index' or a 'delete' operation of the document for the consumer of the search queue, see
+        'consume_search_queue'.
+
+        The operation is applied right away if the queue is disabled or not available.
+        """
+        if not self.id or not hasattr(self, 'to_search_doc'):
+            return
+        if options.search_queue_enabled:
+            try:
+                search_queue.push(self.__class__, self.id, operation)
+                return
+            except:
+                logging.error('Failed to queue {{class={0}.{1}, id={2}}} for search.'.
+                              format(self.__class__.__module__, self.__class__.__name__, self.id))
+        if operation == 'delete':
+            self.__class__.delete_index(self.id)
+        else:
+            self.index_for_search()
+
+    @staticmethod
+    def consume_search_queue():
+        """Apply the operations of the search queue in bulk, forever.
+
+        Batches failing because elasticsearch, MongoDB or the queue itself is not available are retried with an
+        exponential backoff, documents failing to be indexed are queued again until 'options.search_queue_max_attempts'.
+        """
+        backoff, recovered = 0, False
+        while True:
+            try:
+                if not recovered:
+                    # Queue again the operations taken by a previous run or by a failed batch.
+                    search_queue.recover()
+                    recovered = True
+                operations = search_queue.take_batch(options.search_queue_batch_size, 5)
+                if operations:
+                    BaseModel.__apply_search_operations(operations)
+                    search_queue.finish_batch()
+                    logging.info('Applied {0} search index operations, {1} pending.'.
+                                 format(len(operations), search_queue.length()))
+            except Exception:
+                backoff = min(backoff * 2 or 1, _SEARCH_QUEUE_MAX_BACKOFF)
+                logging.exception('Failed to apply the search index operations, retrying in {0} seconds.'.
+                                  format(backoff))
+                recovered = False
+                time.sleep(backoff)
+                continue
+            backoff = 0
+
+    @staticmethod
+    def __apply_search_operations(operations):
+        """Index the documents of the operations as they are now in MongoDB, or delete them from the index if they
+        are gone, so that the order of the operations does not matter.
+        """
+        operations_by_model = dict()
+        for operation in operations:
+            operations_by_model.setdefault(operation['model'], dict())[operation['id']] = operation
+        actions, models = list(), dict()
+        for model_path, operations_by_id in operations_by_model.items():
+            module_name, _, class_name = model_path.rpartition('.')
+            model = getattr(importlib.import_module(module_name), class_name)
+            models[model.__name__.lower()] = model
+            documents = {str(document.id): document for document in model.objects(id__in=list(operations_by_id))}
+            for id in operations_by_id:
+                action = {'_index': options.elasticsearch_index, '_type': model.__name__.lower(), '_id': id}
+                if id in documents:
+                    action.update(_op_type='index', _source=documents[id].to_search_doc())
+                else:
+                    action.update(_op_type='delete')
+                actions.append(action)
+        _, errors = bulk(_elasticsearch, actions, raise_on_error=False)
+        for error in errors:
+            operation_type, item = next(iter(error.items()))
+            if operation_type == 'delete' and item.get('status') == 404:
+                continue
+            model = models[item['_type']]
+            operation = operations_by_model['{0}.{1}'.format(model.__module__, model.__name__)][item['_id']]
+            if operation['attempts'] + 1 >= options.search_queue_max_attempts:
+                logging.error('Failed to {0} {{class={1}.{2}, id={3}}} for search: {4}'.
+                              format(operation_type, model.__module__, model.__name__, item['_id'], item))
+            else:
+                search_queue.push(model, item['_id'], operation['operation'], operation['attempts'] + 1)
+
+    @classmethod
+    def reconcile_search_index(cls, full=False):
+        """Fix the documents of the class whose search index entry is missing or outdated, and delete the index
+        entries of deleted documents. Returns the numbers of reindexed and deleted entries.
+
+        Only the documents updated since the previous reconciliation are checked, and the index is scanned for
+        deleted documents only if it does not hold as many entries as MongoDB, unless 'full' is set.
+        """
+        if not hasattr(cls, 'to_search_doc'):
+            return 0, 0
+        started_at, doc_type = datetime.now(), cls.__name__.lower()
+        watermark = 0 if full else search_queue.get_watermark(doc_type)
+        documents = cls.objects(updateTime__gte=from_milliseconds(max(watermark - _RECONCILIATION_OVERLAP, 0))).\
+            only('updateTime').no_cache().timeout(False)
+        reindexed_count, batch = 0, list()
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= options.elasticsearch_bulk_chunk_size:
+                reindexed_count += cls.__reindex_outdated(batch)
+                batch.clear()
+        if batch:
+            reindexed_count += cls.__reindex_outdated(batch)
+        deleted_count = 0
+        if full or _elasticsearch.count(index=options.elasticsearch_index, doc_type=doc_type)['count'] != \
+                cls.objects.count():
+            deleted_count = cls.__delete_orphans()
+        search_queue.set_watermark(doc_type, to_milliseconds(started_at))
+        logging.info('Reconciled {0} for search, {1} reindexed, {2} deleted.'.
+                     format(cls.__name__, reindexed_count, deleted_count))
+        return reindexed_count, deleted_count
+
+    @classmethod
+    def __reindex_outdated(cls, documents):
+        response = _elasticsearch.mget(index=options.elasticsearch_index, doc_type=cls.__name__.lower(),
+                                       body={'ids': [str(document.id) for document in documents]},
+                                       _source_include=['updateTime'])
+        indexed_update_times = {doc['_id']: doc['_source'].get('updateTime')
+                                for doc in response['docs'] if doc.get('found')}
+        outdated_ids = [document.id for document in documents
+                        if indexed_update_times.get(str(document.id)) != to_milliseconds(document.updateTime)]
+        if outdated_ids:
+            cls.bulk_index_for_search(cls.objects(id__in=outdated_ids))
+        return len(outdated_ids)
+
     @classmethod
-    def do_search(cls, query, page_num, page_size, **kwargs):
+    def __delete_orphans(cls):
+        doc_type, deleted_count, ids = cls.__name__.lower(), 0, list()
+        hits = scan(_elasticsearch, index=options.elasticsearch_index, doc_type=doc_type,
+                    query={'query': {'match_all': {}}, '_source': False}, size=options.elasticsearch_bulk_chunk_size)
+        for hit in hits:
+            ids.append(hit['_id'])
+            if len(ids) >= options.elasticsearch_bulk_chunk_size:
+                deleted_count += cls.__delete_missing(ids)
+                ids.clear()
+        if ids:
+            deleted_count += cls.__delete_missing(ids)
+        return deleted_count
+
+    @classmethod
+    def __delete_missing(cls, ids):
+        existing_ids = {str(document.id) for document in cls.objects(id__in=ids).only('id')}
+        actions = [{'_op_type': 'delete', '_index': options.elasticsearch_index, '_type': cls.__name__.lower(),
+                    '_id': id} for id in ids if id not in existing_ids]
+        if actions:
+            bulk(_elasticsearch, actions, raise_on_error=False)
+        return len(actions)
+
+    @classmethod
+    def bulk_index_for_search(cls, documents):
+        """Index many MongoDB documents for elasticsearch in a single request, return the number of indexed documents.
+
+        Used by batch jobs instead of calling 'index_for_search' once per document.
+        """
+        if not hasattr(cls, 'to_search_doc'):
+            return 0
+        actions = [{'_index': options.elasticsearch_index,
+                    '_type': cls.__name__.lower(),
+                    '_id': str(document.id),
+                    '_source': document.to_search_doc()} for document in documents]
+        try:
+            success_count, errors = bulk(_elasticsearch, actions, raise_on_error=False)
+        except:
+            logging.error('Failed to index {0} {{class={1}.{2}}} for search.'.
+                          format(len(actions), cls.__module__, cls.__name__))
+            return 0
+        for error in errors:
+            logging.error('Failed to index {{class={0}.{1}, error={2}}} for search.'.
+                          format(cls.__module__, cls.__name__, error))
+        return success_count
+
+    @staticmethod
+    def rebuild_search_index(models, replace_index=False):
+        """Rebuild the elasticsearch index from MongoDB without search downtime.
+
+        Documents of the given models are bulk indexed by a bounded pool of threads into a new versioned index,
+        then the alias is switched to it atomically, the old indices are deleted, and the documents deleted in the
+        meantime are deleted from the new index. Models may define a 'search_mapping' for their document type.
+
+        An index created before aliases were used has to be deleted before the alias can take its name, search is
+        down until the alias is added and any write in between would create the index again. This is only done
+        with 'replace_index', with the search queue enabled, and its consumer and search_reconcile stopped until the
+        rebuild is done.
+        """
+        alias, started_at = options.elasticsearch_index, datetime.now()
+        is_index = _elasticsearch.indices.exists(index=alias) and not _elasticsearch.indices.exists_alias(name=alias)
+        if is_index and not (replace_index and options.search_queue_enabled):
+            raise Exception('{0} is an index rather than an alias, enable the search queue, stop its consumer and '
+                            'search_reconcile, and rebuild with replace_index to replace it.'.format(alias))
+        new_index = '{0}_{1}'.format(alias, time.strftime('%Y%m%d%H%M%S'))
+        mappings = {model.__name__.lower(): model.search_mapping for model in models
+                    if hasattr(model, 'search_mapping')}
+        _elasticsearch.indices.create(index=new_index, body={'settings': {'refresh_interval': '-1'},
+                                                             'mappings': mappings})
+        BaseModel.__parallel_index(new_index, models, {})
+        # Catch up with the documents saved while indexing.
+        BaseModel.__parallel_index(new_index, models, {'updateTime__gte': started_at})
+        _elasticsearch.indices.put_settings(index=new_index, body={'refresh_interval': '1s'})
+        _elasticsearch.indices.refresh(index=new_index)
+        try:
+            old_indices = list(_elasticsearch.indices.get_alias(name=alias).keys())
+        except NotFoundError:
+            old_indices = list()
+        if is_index:
+            logging.warning('Deleting index {0} to replace it with an alias.'.format(alias))
+            _elasticsearch.indices.delete(index=alias)
+        actions = [{'remove': {'index': index, 'alias': alias}} for index in old_indices]
+        actions.append({'add': {'index': new_index, 'alias': alias}})
+        _elasticsearch.indices.update_aliases(body={'actions': actions})
+        for index in old_indices:
+            _elasticsearch.indices.delete(index=index)
+        # Documents deleted while indexing were deleted from the old index only.
+        for model in models:
+            if hasattr(model, 'to_search_doc'):
+                model.__delete_orphans()
+        return new_index
+
+    @staticmethod
+    def __parallel_index(index, models, query):
+        for model in models:
+            documents = model.objects(**query).no_cache().timeout(False)
+            actions = ({'_index': index,
+                        '_type': model.__name__.lower(),
+                        '_id': str(document.id),
+                        '_source': document.to_search_doc()} for document in documents)
+            for succeeded, item in parallel_bulk(_elasticsearch, actions,
+                                                 thread_count=options.elasticsearch_bulk_threads,
+                                                 chunk_size=options.elasticsearch_bulk_chunk_size,
+                                                 raise_on_error=False):
+                if not succeeded:
+                    logging.error('Failed to index {{class={0}.{1}, error={2}}} for search.'.
+                                  format(model.__module__, model.__name__, item))
+
+    @classmethod
+    def do_search(cls, query, page_num, page_size, source=None, highlight=None, cache_expire_after=None, **kwargs):
         """Do perform an elasticsearch search operation, return the paginated result.
+
+        source: the '_source' fields to return, all fields but the ones starting with '_' if None
+        highlight: the elasticsearch highlight request, fragments are returned in 'SearchResult.highlights'
+        cache_expire_after: if set, the hits are cached for that many seconds, or until a document of the class is
+        saved or deleted
         """
-        class SearchResult:
-            def __init__(self, hit):
-                self.id = hit['_id']
-                for key, value in hit['_source'].items():
-                    if key.startswith('_'):
-                        pass
-                    else:
-                        self.__dict__[key] = value
+        body = {'query': query, '_source': source if source is not None else {'exclude': ['_*']}}
+        if highlight:
+            body['highlight'] = highlight
+        cache_key = None
+        if cache_expire_after:
+            arguments = json.dumps([body, page_num, page_size, kwargs], sort_keys=True).encode('utf-8')
+            try:
+                cache_key = 'search:{0}:{1}:{2}'.format(cls.__name__, get_generations(cls.__name__)[0],
+                                                        md5(arguments).hexdigest())
+                hits = get_cache(cache_key)
+            except:
+                # Search without the cache, the results must not be cached without a generation either.
+                logging.error('Failed to read the search cache.')
+                cache_key, hits = None, None
+            if hits is not None:
+                hits = json.loads(hits)
+                return cls.__paginate_search_hits(hits, page_num, page_size)
         search_result = _elasticsearch.search(index=options.elasticsearch_index,
                                               doc_type=cls.__name__.lower(),
-                                              body={'query': query},
+                                              body=body,
                                               size=page_size, from_=page_size * page_num,
                                               **kwargs)
-        if not search_result or search_result['timed_out'] or search_result['hits']['total'] == 0:
+        if not search_result or search_result['timed_out']:
+            return 0, 1, []
+        hits = {'total': search_result['hits']['total'],
+                'hits': [{'_id': hit['_id'], '_source': hit.get('_source', {}), 'highlight': hit.get('highlight', {})}
+                         for hit in search_result['hits']['hits']]}
+        if cache_key:
+            try:
+                set_cache(cache_key, json.dumps(hits), ex=cache_expire_after)
+            except:
+                logging.error('Failed to write the search cache.')
+        return cls.__paginate_search_hits(hits, page_num, page_size)
+
+    @staticmethod
+    def __paginate_search_hits(hits, page_num, page_size):
+        if hits['total'] == 0:
             return 0, 1, []
-        page_num, page_count = BaseModel.__calc_page_num_and_page_count(search_result['hits']['total'],
-                                                                        page_num, page_size)
-        return page_num, page_count, [SearchResult(hit) for hit in search_result['hits']['hits']]
+        page_num, page_count = BaseModel.__calc_page_num_and_page_count(hits['total'], page_num, page_size)
+        return page_num, page_count, [SearchResult(hit) for hit in hits['hits']]
+
+    @classmethod
+    def do_search_async(cls, query, page_num, page_size, **kwargs):
+        """Coroutine version of the 'do_search' method.
+        """
+        return run_in_executor(cls.do_search, query, page_num, page_size, **kwargs)
 
     @classmethod
     def delete_index(cls, id):
@@ -150,8 +505,8 @@ class BaseModel(Document):
 
     def to_vo(self, **kwargs):
         return {'id': str(self.id),
-                'createTime': int(self.createTime.timestamp() * 1000),
-                'updateTime': int(self.updateTime.timestamp() * 1000)}
+                'createTime': to_milliseconds(self.createTime),
+                'updateTime': to_milliseconds(self.updateTime)}
 
     @staticmethod
     def __calc_page_num_and_page_count(total_count, page_num, page_size):
@@ -165,6 +520,37 @@ class BaseModel(Document):
         return page_num, page_count
 
 
+class SearchResult:
+    """A search hit, the requested '_source' fields are read as attributes.
+
+    highlights: {field: [highlighted fragments]}
+    """
+    __slots__ = ('id', 'fields', 'highlights')
+
+    def __init__(self, hit):
+        self.id = hit['_id']
+        self.fields = hit['_source']
+        self.highlights = hit['highlight']
+
+    def __getattr__(self, name):
+        try:
+            return self.fields[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def to_milliseconds(time):
+    """Returns a datetime as milliseconds since the epoch, exactly, as MongoDB stores datetimes in milliseconds.
+    """
+    return int(time.replace(microsecond=0).timestamp()) * 1000 + time.microsecond // 1000
+
+
+def from_milliseconds(milliseconds):
+    """The reverse of 'to_milliseconds'.
+    """
+    return datetime.fromtimestamp(milliseconds // 1000) + timedelta(milliseconds=milliseconds % 1000)
+
+
 class Image(EmbeddedDocument):
     """Image information.
 
@@ -0,0 +1,159 @@
+import json
+import time
+import hmac
+import hashlib
+import logging
+from uuid import uuid4
+from threading import Lock
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+import redis
+from tornado.options import options
+
+
+_redis_session_db_pool = redis.ConnectionPool(host=options.redis_session_db_host,
+                                              port=options.redis_session_db_port,
+                                              db=options.redis_session_db_database,
+                                              decode_responses=True,
+                                              socket_timeout=options.redis_session_db_timeout)
+
+_MIN_SESSION_SECRET_LENGTH = 32
+
+
+class SessionBackend:
+    """Interface of the session backends, the one used is chosen by 'options.session_backend'.
+
+    Session data is a dict holding at least 'userId' and 'permissions'.
+    """
+    def generate(self, session_data):
+        """Store a new session and return the session ID, or None if failed.
+        """
+        raise NotImplementedError
+
+    def get(self, session_id):
+        """Returns the session data, or None if the session does not exist or has expired.
+        """
+        raise NotImplementedError
+
+    def set(self, session_id, session_data):
+        """Replace the session data, returns whether the session exists.
+        """
+        raise NotImplementedError
+
+    def invalidate(self, session_id):
+        raise NotImplementedError
+
+
+class RedisSessionBackend(SessionBackend):
+    """Sessions stored in Redis, the session ID is a random key.
+    """
+    def generate(self, session_data):
+        session_data_str = json.dumps(session_data)
+        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+        for retry_times in range(3):
+            if retry_times > 0:
+                logging.warning('Generated duplicate session ID, will try a new one.')
+            session_id = '{0:x}{1}'.format(int(time.time()), uuid4().hex)
+            if redis_client.set(session_id, session_data_str, ex=options.session_expire_after, nx=True):
+                return session_id
+        return None
+
+    def get(self, session_id):
+        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+        session_data = redis_client.get(session_id)
+        return json.loads(session_data) if session_data else None
+
+    def set(self, session_id, session_data):
+        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+        return bool(redis_client.set(session_id, json.dumps(session_data), ex=options.session_expire_after, xx=True))
+
+    def invalidate(self, session_id):
+        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+        redis_client.delete(session_id)
+
+
+class SignedSessionBackend(SessionBackend):
+    """Sessions carried by the session ID itself, a token signed with HMAC-SHA256 by 'options.session_secret'.
+
+    Reading a session needs no Redis round trip. Invalidated tokens are kept in a Redis sorted set until they
+    expire, and each process refreshes its copy of the set every 'options.session_revocation_refresh_interval'
+    seconds, so a token invalidated by another process is trusted that long at most.
+    """
+    REVOKED_SESSIONS_KEY = 'revoked_sessions'
+
+    def __init__(self, secret, refresh_interval):
+        self.secret = secret.encode('utf-8')
+        self.refresh_interval = refresh_interval
+        self.lock = Lock()
+        self.revoked_session_ids = set()
+        self.refreshed_at = 0
+
+    def generate(self, session_data):
+        payload = dict(session_data, jti=uuid4().hex, exp=int(time.time()) + options.session_expire_after)
+        payload = _b64encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        return '{0}.{1}'.format(payload, self.__sign(payload))
+
+    def get(self, session_id):
+        session_data = self.__verify(session_id)
+        if not session_data or session_data.pop('exp') < time.time() or self.__is_revoked(session_data.pop('jti')):
+            return None
+        return session_data
+
+    def set(self, session_id, session_data):
+        """Signed sessions can not be changed, generate a new session instead.
+        """
+        return False
+
+    def invalidate(self, session_id):
+        session_data = self.__verify(session_id)
+        if not session_data:
+            return
+        redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+        redis_client.zadd(SignedSessionBackend.REVOKED_SESSIONS_KEY, session_data['exp'], session_data['jti'])
+        with self.lock:
+            self.revoked_session_ids.add(session_data['jti'])
+
+    def __verify(self, session_id):
+        """Returns the payload of a token if its signature is valid.
+        """
+        payload, _, signature = session_id.partition('.')
+        if not hmac.compare_digest(signature.encode('utf-8'), self.__sign(payload).encode('utf-8')):
+            return None
+        try:
+            return json.loads(urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+        except ValueError:
+            return None
+
+    def __is_revoked(self, jti):
+        now = time.time()
+        with self.lock:
+            if now - self.refreshed_at >= self.refresh_interval:
+                self.refreshed_at = now
+                try:
+                    redis_client = redis.StrictRedis(connection_pool=_redis_session_db_pool)
+                    redis_client.zremrangebyscore(SignedSessionBackend.REVOKED_SESSIONS_KEY, '-inf', now)
+                    self.revoked_session_ids = set(redis_client.zrangebyscore(
+                            SignedSessionBackend.REVOKED_SESSIONS_KEY, now, '+inf'))
+                except:
+                    logging.error('Failed to refresh the revoked sessions.')
+            return jti in self.revoked_session_ids
+
+    def __sign(self, payload):
+        return _b64encode(hmac.new(self.secret, payload.encode('utf-8'), hashlib.sha256).digest())
+
+
+def _b64encode(data):
+    return urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _create_session_backend():
+    if options.session_backend == 'signed':
+        # Anyone knowing the secret can sign a session with any permissions.
+        if len(options.session_secret) < _MIN_SESSION_SECRET_LENGTH:
+            raise Exception('session_secret must be at least {0} characters long to use signed sessions.'.
+                            format(_MIN_SESSION_SECRET_LENGTH))
+        return SignedSessionBackend(options.session_secret, options.session_revocation_refresh_interval)
+    return RedisSessionBackend()
+
+
+session_backend = _create_session_backend()
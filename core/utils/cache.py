@@ -0,0 +1,57 @@
+import logging
+
+import redis
+from tornado.options import options
+
+
+_redis_cache_db_pool = redis.ConnectionPool(host=options.redis_cache_db_host,
+                                            port=options.redis_cache_db_port,
+                                            db=options.redis_cache_db_database,
+                                            decode_responses=True,
+                                            socket_timeout=options.redis_cache_db_timeout)
+
+
+def get_cache(key):
+    """Get cached value.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+    return redis_client.get(key)
+
+
+def set_cache(key, value, ex=None):
+    """Set cache value.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+    return redis_client.set(key, value, ex=ex)
+
+
+def get_generations(*names):
+    """Returns the generation counters of the given names, a cache key containing them is outdated once one of them
+    is increased.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+    return [generation or '0' for generation in redis_client.mget(['generation:{0}'.format(name) for name in names])]
+
+
+def increase_generation(name):
+    """Outdate the cache keys containing the generation counter of the given name.
+
+    Errors are logged rather than raised, the outdated keys expire anyway.
+    """
+    try:
+        redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+        redis_client.incr('generation:{0}'.format(name))
+    except:
+        logging.error('Failed to increase the cache generation of {0}.'.format(name))
+
+
+def acquire_lock(key, ex):
+    """Returns whether the lock is acquired, the lock is released after 'ex' seconds if not released before.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+    return bool(redis_client.set('lock:{0}'.format(key), '1', ex=ex, nx=True))
+
+
+def release_lock(key):
+    redis_client = redis.StrictRedis(connection_pool=_redis_cache_db_pool)
+    redis_client.delete('lock:{0}'.format(key))
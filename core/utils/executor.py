@@ -0,0 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.options import options
+
+
+#
+# pymongo, elasticsearch-py and redis-py are all blocking, so the coroutine versions of the data access methods
+# run them in a bounded thread pool. The threads are started on first use, after the worker processes are forked.
+#
+_executor = ThreadPoolExecutor(options.io_thread_pool_size)
+
+
+def run_in_executor(function, *args, **kwargs):
+    """Run a blocking function in the I/O thread pool, returns a future which can be yielded in coroutines.
+    """
+    return _executor.submit(function, *args, **kwargs)
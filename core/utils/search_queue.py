@@ -0,0 +1,87 @@
+import json
+import logging
+
+import redis
+from tornado.options import options
+
+
+#
+# Pending index and delete operations are pushed to the queue, the consumer moves a batch to the processing list,
+# applies it, and empties the processing list. A batch left in the processing list by a crashed consumer is moved
+# back to the queue when the consumer starts again, so there must be a single consumer.
+#
+_QUEUE_KEY, _PROCESSING_KEY = 'search_queue', 'search_queue:processing'
+
+_redis_queue_db_pool = redis.ConnectionPool(host=options.redis_queue_db_host,
+                                            port=options.redis_queue_db_port,
+                                            db=options.redis_queue_db_database,
+                                            decode_responses=True,
+                                            socket_timeout=options.redis_queue_db_timeout)
+
+#
+# Saves push with a short timeout, so that an unavailable queue makes them fall back to inline indexing at once
+# instead of waiting as long as the consumer's blocking reads.
+#
+_redis_queue_db_push_pool = redis.ConnectionPool(host=options.redis_queue_db_host,
+                                                 port=options.redis_queue_db_port,
+                                                 db=options.redis_queue_db_database,
+                                                 decode_responses=True,
+                                                 socket_timeout=options.redis_queue_db_push_timeout)
+
+
+def push(model, id, operation, attempts=0):
+    """Queue an 'index' or a 'delete' operation of a document.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_queue_db_push_pool)
+    redis_client.lpush(_QUEUE_KEY, json.dumps({'model': '{0}.{1}'.format(model.__module__, model.__name__),
+                                               'id': str(id), 'operation': operation, 'attempts': attempts}))
+
+
+def take_batch(batch_size, timeout):
+    """Move at most 'batch_size' operations to the processing list and return them, waiting at most 'timeout'
+    seconds for the first one.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_queue_db_pool)
+    item = redis_client.brpoplpush(_QUEUE_KEY, _PROCESSING_KEY, timeout)
+    items = [item] if item else []
+    while item and len(items) < batch_size:
+        item = redis_client.rpoplpush(_QUEUE_KEY, _PROCESSING_KEY)
+        if item:
+            items.append(item)
+    return [json.loads(item) for item in items]
+
+
+def finish_batch():
+    redis_client = redis.StrictRedis(connection_pool=_redis_queue_db_pool)
+    redis_client.delete(_PROCESSING_KEY)
+
+
+def recover():
+    """Move the operations left in the processing list back to the queue, returns their number.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_queue_db_pool)
+    count = 0
+    while redis_client.rpoplpush(_PROCESSING_KEY, _QUEUE_KEY):
+        count += 1
+    if count:
+        logging.warning('Recovered {0} search index operations.'.format(count))
+    return count
+
+
+def length():
+    """Returns the number of pending operations, the search index is stale by that many documents at most.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_queue_db_pool)
+    return redis_client.llen(_QUEUE_KEY) + redis_client.llen(_PROCESSING_KEY)
+
+
+def get_watermark(name):
+    """Returns the update time, in milliseconds, up to which the search index has been reconciled with MongoDB.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_queue_db_pool)
+    return int(redis_client.get('search_watermark:{0}'.format(name)) or 0)
+
+
+def set_watermark(name, watermark):
+    redis_client = redis.StrictRedis(connection_pool=_redis_queue_db_pool)
+    redis_client.set('search_watermark:{0}'.format(name), watermark)
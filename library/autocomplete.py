@@ -0,0 +1,89 @@
+import unicodedata
+from collections import Counter
+
+import redis
+from tornado.options import options
+
+
+#
+# For every prefix of a name, a sorted set holds the names starting with it, scored by their number of libraries,
+# so a lookup is a single ZREVRANGE. Prefixes are taken by character, not by byte, and are at most
+# _MAX_PREFIX_LENGTH characters long, which covers Chinese names entirely and bounds the keys of long titles.
+#
+_MAX_PREFIX_LENGTH = 10
+_KEY_PREFIX = 'autocomplete'
+
+FIELDS = ('player', 'title')
+
+_redis_autocomplete_db_pool = redis.ConnectionPool(host=options.redis_autocomplete_db_host,
+                                                   port=options.redis_autocomplete_db_port,
+                                                   db=options.redis_autocomplete_db_database,
+                                                   decode_responses=True,
+                                                   socket_timeout=options.redis_autocomplete_db_timeout)
+
+
+def suggest(field, prefix, limit=10):
+    """Returns the names of the field starting with the prefix, the most used first.
+    """
+    prefix = _normalize(prefix)
+    if field not in FIELDS or not prefix:
+        return list()
+    redis_client = redis.StrictRedis(connection_pool=_redis_autocomplete_db_pool)
+    if len(prefix) <= _MAX_PREFIX_LENGTH:
+        return redis_client.zrevrange(_key(field, prefix), 0, limit - 1)
+    # The rest of a long prefix is matched here.
+    names = redis_client.zrevrange(_key(field, prefix[:_MAX_PREFIX_LENGTH]), 0, limit * 10 - 1)
+    return [name for name in names if _normalize(name).startswith(prefix)][:limit]
+
+
+def update_counts(counts):
+    """Apply a {(field, name): increment} dict, and remove the names dropping to zero.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_autocomplete_db_pool)
+    pipeline = redis_client.pipeline(transaction=False)
+    decreased_keys = set()
+    for (field, name), count in counts.items():
+        name = unicodedata.normalize('NFKC', name or '').strip()
+        if not count or not name:
+            continue
+        for key in _prefix_keys(field, name):
+            pipeline.zincrby(key, name, count)
+            if count < 0:
+                decreased_keys.add(key)
+    for key in decreased_keys:
+        pipeline.zremrangebyscore(key, '-inf', 0)
+    pipeline.execute()
+
+
+def names_of(title, black_player_name, white_player_name):
+    """Returns the (field, name) pairs of a library, to be counted by 'update_counts'.
+    """
+    return Counter([('title', title), ('player', black_player_name), ('player', white_player_name)])
+
+
+def clear():
+    redis_client = redis.StrictRedis(connection_pool=_redis_autocomplete_db_pool)
+    keys = list()
+    for key in redis_client.scan_iter('{0}:*'.format(_KEY_PREFIX), count=1000):
+        keys.append(key)
+        if len(keys) >= 1000:
+            redis_client.delete(*keys)
+            keys.clear()
+    if keys:
+        redis_client.delete(*keys)
+
+
+def _prefix_keys(field, name):
+    normalized_name = _normalize(name)
+    return [_key(field, normalized_name[:length])
+            for length in range(1, min(len(normalized_name), _MAX_PREFIX_LENGTH) + 1)]
+
+
+def _normalize(name):
+    """Full-width and half-width forms are matched alike, as are upper and lower case and runs of spaces.
+    """
+    return ' '.join(unicodedata.normalize('NFKC', name).casefold().split())
+
+
+def _key(field, prefix):
+    return '{0}:{1}:{2}'.format(_KEY_PREFIX, field, prefix)
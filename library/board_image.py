@@ -0,0 +1,80 @@
+import os
+import logging
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+from tornado.options import options
+
+from library.manual import NUM_LINES
+
+
+#
+# The board image is drawn like the board of the viewer: 25 pixels cells, with a column of line numbers on the left
+# and a row of letters at the bottom, so the point (x, y) is drawn at ((x + 1) * 25, (NUM_LINES - 1 - y) * 25).
+#
+_IMAGE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'img')
+_CELL_SIZE = 25
+_LAST_MOVE_RADIUS = 3
+
+SIZE = _CELL_SIZE * (NUM_LINES + 1)
+THUMBNAIL_SIZE = 120
+
+_board = Image.open(os.path.join(_IMAGE_PATH, 'board.png')).convert('RGBA')
+_stones = [Image.open(os.path.join(_IMAGE_PATH, name)).convert('RGBA')
+           for name in ('black_stone.png', 'white_stone.png')]
+
+
+def render(moves, size=SIZE):
+    """Returns the PNG of the position reached by the given (x, y) moves, pass moves being (-1, -1).
+    """
+    image = _board.copy()
+    last_point = None
+    for ply, (x, y) in enumerate(moves):
+        if not (0 <= x < NUM_LINES and 0 <= y < NUM_LINES):
+            continue
+        last_point = ((x + 1) * _CELL_SIZE, (NUM_LINES - 1 - y) * _CELL_SIZE)
+        image.paste(_stones[ply % 2], last_point, _stones[ply % 2])
+    if last_point is not None:
+        center_x, center_y = last_point[0] + _CELL_SIZE // 2, last_point[1] + _CELL_SIZE // 2
+        ImageDraw.Draw(image).ellipse((center_x - _LAST_MOVE_RADIUS, center_y - _LAST_MOVE_RADIUS,
+                                       center_x + _LAST_MOVE_RADIUS, center_y + _LAST_MOVE_RADIUS), fill='#ff0000')
+    if size != SIZE:
+        image = image.resize((size, size), Image.LANCZOS)
+    output = BytesIO()
+    image.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+
+def get_cached(library_id, update_time, ply, size):
+    """Returns the cached PNG of a library, or None if the library has not been drawn since it was last updated.
+    """
+    try:
+        with open(_cache_path(library_id, update_time, ply, size), 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def set_cached(library_id, update_time, ply, size, image):
+    """Cache the PNG of a library, and remove the images of its older versions.
+    """
+    path = _cache_path(library_id, update_time, ply, size)
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if int(name.split('_')[0]) < update_time:
+                os.remove(os.path.join(directory, name))
+        temp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            file.write(image)
+        os.replace(temp_path, path)
+    except (OSError, ValueError):
+        logging.exception('Failed to cache the board image of library {0}.'.format(library_id))
+
+
+def _cache_path(library_id, update_time, ply, size):
+    # One directory per library, spread over 256 directories.
+    library_id = str(library_id)
+    return os.path.join(options.library_board_image_path, library_id[-2:], library_id,
+                        '{0}_{1}_{2}.png'.format(update_time, ply, size))
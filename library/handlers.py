@@ -1,57 +1,167 @@
+from itertools import islice
+
+import tornado.web
+import tornado.websocket
+from tornado import gen
+from bson import ObjectId
+
 from core.handlers import ApiHandler, PageHandler
-from core.decorators import check_params, require_permissions
-from library.models import Library, HotKeyword
+from core.decorators import check_params, require_permissions, cache_page, check_modified, generation_version
+from core.models import OutdatedDocument, to_milliseconds, from_milliseconds
+from core.utils.executor import run_in_executor
+from library.models import Library, HotKeyword, OpeningStat
+from library.manual import InvalidManual, MAX_DEPTH, trim_manual
+from library.records import format_records
+from library import autocomplete, live, board_image
 
 
 class LibraryApiSaveHandler(ApiHandler):
-    @check_params('id', 'title', 'blackPlayerName', 'whitePlayerName', 'manual')
+    @check_params('id', 'updateTime', 'title', 'blackPlayerName', 'whitePlayerName', 'manual')
     @require_permissions('root')
+    @gen.coroutine
     def post(self, *args, **kwargs):
         library_id = self.get_str_argument('id', '')
+        update_time = self.get_int_argument('updateTime')
         title = self.get_str_argument('title', '')
         black_player_name = self.get_str_argument('blackPlayerName', '')
         white_player_name = self.get_str_argument('whitePlayerName', '')
         manual = self.get_json_argument('manual', {})
-        library = Library.save_and_index(self.current_user, id=library_id, title=title,
-                                         blackPlayerName=black_player_name, whitePlayerName=white_player_name,
-                                         manual=manual)
-        return self.api_succeeded({'id': str(library.id)})
+        # Given the update time of the library being edited, the save fails if someone else has saved it since.
+        old_update_time = from_milliseconds(update_time) if library_id and update_time else None
+        try:
+            library = yield Library.save_and_index_async(self.current_user, id=library_id,
+                                                         old_update_time=old_update_time, title=title,
+                                                         blackPlayerName=black_player_name,
+                                                         whitePlayerName=white_player_name, manual=manual)
+        except InvalidManual:
+            return self.api_failed(4, 'Invalid manual.')
+        except OutdatedDocument:
+            return self.api_failed(6, 'Outdated.')
+        return self.api_succeeded({'id': str(library.id), 'updateTime': to_milliseconds(library.updateTime)})
+
+
+class LibraryApiPatchHandler(ApiHandler):
+    @check_params('id', 'updateTime', 'title', 'blackPlayerName', 'whitePlayerName', 'operations')
+    @require_permissions('root')
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        library_id = self.get_str_argument('id', '')
+        update_time = self.get_int_argument('updateTime')
+        title = self.get_str_argument('title', '')
+        black_player_name = self.get_str_argument('blackPlayerName', '')
+        white_player_name = self.get_str_argument('whitePlayerName', '')
+        operations = self.get_json_argument('operations', [])
+        try:
+            library = yield Library.patch_manual_async(self.current_user, library_id, update_time, operations,
+                                                       title=title, blackPlayerName=black_player_name,
+                                                       whitePlayerName=white_player_name)
+        except InvalidManual:
+            return self.api_failed(4, 'Invalid manual.')
+        except OutdatedDocument:
+            return self.api_failed(6, 'Outdated.')
+        return self.api_succeeded({'id': str(library.id), 'updateTime': to_milliseconds(library.updateTime)})
+
+
+class LibraryApiExploreHandler(ApiHandler):
+    @check_params('moves')
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        moves = self.get_json_argument('moves', [])
+        continuations = yield OpeningStat.explore_async(moves)
+        return self.api_succeeded({'continuations': continuations})
+
+
+class LibraryApiSearchHandler(ApiHandler):
+    @check_params('keyword', 'moves', 'page')
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        keyword = self.get_str_argument('keyword', '')
+        moves = self.get_json_argument('moves', [])
+        page_num = self.get_int_argument('page')
+        page_num, page_count, libraries = yield Library.search_text_by_page_async(keyword, page_num, moves=moves)
+        return self.api_succeeded({'libraries': [{'id': library.id,
+                                                  'title': library.title,
+                                                  'blackPlayerName': library.blackPlayerName,
+                                                  'whitePlayerName': library.whitePlayerName}
+                                                 for library in libraries],
+                                   'pageNum': page_num,
+                                   'pageCount': page_count})
+
+
+class LibraryApiSubtreeHandler(ApiHandler):
+    @check_params('id', 'updateTime', 'path')
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        library_id = self.get_str_argument('id', '')
+        update_time = self.get_int_argument('updateTime')
+        path = self.get_json_argument('path', [])
+        try:
+            subtree = yield Library.get_subtree_async(library_id, update_time, path)
+        except InvalidManual:
+            return self.api_failed(4, 'Invalid path.')
+        except OutdatedDocument:
+            return self.api_failed(6, 'Outdated.')
+        return self.api_succeeded({'subtree': subtree})
+
+
+class LibraryApiAutocompleteHandler(ApiHandler):
+    @check_params('field', 'prefix')
+    @gen.coroutine
+    def post(self, *args, **kwargs):
+        field = self.get_str_argument('field', '')
+        prefix = self.get_str_argument('prefix', '')
+        names = yield run_in_executor(autocomplete.suggest, field, prefix)
+        return self.api_succeeded({'names': names})
 
 
 class LibraryApiSaveHotKeywordHandler(ApiHandler):
     @check_params('id', 'keyword')
     @require_permissions('root')
+    @gen.coroutine
     def post(self, *args, **kwargs):
         hot_keyword_id = self.get_str_argument('id', '')
         hot_keyword_keyword = self.get_str_argument('keyword', '')
-        hot_keyword = HotKeyword.save_and_index(self.current_user, id=hot_keyword_id, keyword=hot_keyword_keyword)
+        hot_keyword = yield HotKeyword.save_and_index_async(self.current_user, id=hot_keyword_id,
+                                                            keyword=hot_keyword_keyword)
         return self.api_succeeded({'id': str(hot_keyword.id)})
 
 
 class LibraryApiDeleteHotKeywordHandler(ApiHandler):
     @check_params('id')
     @require_permissions('root')
+    @gen.coroutine
     def post(self, *args, **kwargs):
         hot_keyword_id = self.get_str_argument('id', '')
-        hot_keyword = HotKeyword.objects(id=hot_keyword_id)
-        hot_keyword.delete()
+        hot_keyword = yield run_in_executor(HotKeyword.objects(id=hot_keyword_id).first)
+        if hot_keyword:
+            # Deleting the document rather than the query set outdates the cached pages.
+            yield run_in_executor(hot_keyword.delete)
         return self.api_succeeded()
 
 
 __api_handlers__ = [
     (r'^/library/api/save$', LibraryApiSaveHandler),
+    (r'^/library/api/patch$', LibraryApiPatchHandler),
+    (r'^/library/api/explore$', LibraryApiExploreHandler),
+    (r'^/library/api/search$', LibraryApiSearchHandler),
+    (r'^/library/api/subtree$', LibraryApiSubtreeHandler),
+    (r'^/library/api/autocomplete$', LibraryApiAutocompleteHandler),
     (r'^/library/api/saveHotKeyword$', LibraryApiSaveHotKeywordHandler),
     (r'^/library/api/deleteHotKeyword$', LibraryApiDeleteHotKeywordHandler)
 ]
 
 
 class LibraryListHandler(PageHandler):
+    @check_modified(generation_version('Library'), per_user=True)
+    @cache_page('Library', per_user=True)
+    @gen.coroutine
     def get(self, *args, **kwargs):
-        session = self.get_session()
-        page_num = self.get_int_argument('page', 0)
-        libraries, page_num, page_count = Library.list_by_page(page_num)
+        session = yield self.get_session_async()
+        cursor = self.get_str_argument('cursor', '')
+        libraries, next_cursor, total_count = yield Library.list_by_cursor_async(cursor)
         return self.render('library/list.html',
-                           session=session, libraries=libraries, page_num=page_num, page_count=page_count)
+                           session=session, libraries=libraries, cursor=cursor, next_cursor=next_cursor,
+                           total_count=total_count)
 
 
 class LibrarySearchHandler(PageHandler):
@@ -60,26 +170,47 @@ class LibrarySearchHandler(PageHandler):
 
 
 class LibrarySearchTextHandler(PageHandler):
+    @gen.coroutine
     def post(self, *args, **kwargs):
         keyword = self.get_str_argument('keyword', '')
+        moves = self.get_json_argument('moves', [])
         page_num = self.get_int_argument('page')
-        page_num, page_count, libraries = Library.search_text_by_page(keyword, page_num)
+        page_num, page_count, libraries = yield Library.search_text_by_page_async(keyword, page_num, moves=moves)
         return self.render('library/search_text_results.html',
-                           libraries=libraries, keyword=keyword, page_num=page_num, page_count=page_count)
+                           libraries=libraries, keyword=keyword, moves=moves, page_num=page_num,
+                           page_count=page_count)
 
 
 class LibrarySearchManualHandler(PageHandler):
+    @gen.coroutine
     def post(self, *args, **kwargs):
-        search_datas = self.get_json_argument('searchDatas', [])
-        page_num = self.get_int_argument('page')
-        libraries, page_num, page_count = Library.search_manual_by_page(search_datas, page_num)
+        moves = self.get_json_argument('moves', [])
+        cursor = self.get_str_argument('cursor', '')
+        libraries, next_cursor, total_count = yield Library.search_manual_by_cursor_async(moves, cursor)
         return self.render('library/search_manual_results.html',
-                           libraries=libraries, search_datas=search_datas, page_num=page_num, page_count=page_count)
+                           libraries=libraries, moves=moves, cursor=cursor, next_cursor=next_cursor,
+                           total_count=total_count)
+
+
+def _library_version(handler):
+    """The version of a library page is the update time of the library, read without the rest of the library.
+    """
+    library_id = handler.get_str_argument('id', '')
+    if not ObjectId.is_valid(library_id):
+        return None
+    library = Library.objects(id=library_id).only('updateTime').first()
+    if library is None:
+        return None
+    update_time = to_milliseconds(library.updateTime)
+    return '{0}:{1}'.format(library_id, update_time), update_time
 
 
 class LibraryViewOrEditHandler(PageHandler):
+    @check_modified(_library_version)
+    @cache_page('Library')
+    @gen.coroutine
     def get(self, *args, **kwargs):
-        session = self.get_session()
+        session = yield self.get_session_async()
         library_id = self.get_str_argument('id', '')
         # View/edit a blank library or an existing one.
         if len(library_id) == 0:
@@ -87,16 +218,112 @@ class LibraryViewOrEditHandler(PageHandler):
                                library=None,
                                can_edit=session and 'root' in session['permissions'])
         else:
-            library = Library.objects.get(id=library_id)
+            can_edit = session and 'root' in session['permissions']
+            library = yield run_in_executor(Library.objects.exclude('patterns').get, id=library_id)
+            # Editors need the whole manual, viewers get the main line and load the variations they open.
+            manual = library.get_manual() if can_edit else trim_manual(library.get_manual())
             return self.render('library/view_or_edit.html',
-                               library=library,
-                               can_edit=session and 'root' in session['permissions'])
+                               library=library, manual=manual, can_edit=can_edit)
+
+
+class LibraryBoardImageHandler(PageHandler):
+    @gen.coroutine
+    def get(self, *args, **kwargs):
+        library_id = self.get_str_argument('id', '')
+        # Any negative ply shows the final position, and no line is longer than MAX_DEPTH.
+        ply = min(max(self.get_int_argument('ply', -1), -1), MAX_DEPTH)
+        size = board_image.THUMBNAIL_SIZE if self.get_str_argument('thumbnail', '') else board_image.SIZE
+        if not ObjectId.is_valid(library_id):
+            raise tornado.web.HTTPError(404)
+        library = yield run_in_executor(Library.objects(id=library_id).only('updateTime').first)
+        if library is None:
+            raise tornado.web.HTTPError(404)
+        # The image only changes with the library, so it is not even read when the browser has the current one.
+        update_time = to_milliseconds(library.updateTime)
+        self.set_header('Etag', '"{0}-{1}-{2}-{3}"'.format(library_id, update_time, ply, size))
+        self.set_header('Cache-Control', 'public, max-age=60')
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
+        image = yield Library.get_board_image_async(library_id, update_time, ply, size)
+        if image is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'image/png')
+        return self.finish(image)
+
+
+_EXPORT_CONTENT_TYPES = {'ndjson': 'application/x-ndjson; charset=UTF-8',
+                         'txt': 'text/plain; charset=UTF-8',
+                         'rif': 'application/xml; charset=UTF-8'}
+
+
+def _read_export_chunk(lines, size):
+    return ''.join(islice(lines, size))
+
+
+class LibraryExportHandler(PageHandler):
+    @require_permissions('root')
+    @gen.coroutine
+    def get(self, *args, **kwargs):
+        record_format = self.get_str_argument('format', 'ndjson')
+        if record_format not in _EXPORT_CONTENT_TYPES:
+            raise tornado.web.HTTPError(400)
+        player_names = ()
+        if record_format == 'rif':
+            player_names = yield run_in_executor(Library.export_player_names)
+        self.set_header('Content-Type', _EXPORT_CONTENT_TYPES[record_format])
+        self.set_header('Content-Disposition', 'attachment; filename="libraries.{0}"'.format(record_format))
+        # Send the records in chunks, read in the thread pool, waiting for each chunk to be sent before reading more
+        # from the cursor.
+        records = Library.export_records()
+        lines = format_records(records, record_format, player_names)
+        try:
+            while True:
+                chunk = yield run_in_executor(_read_export_chunk, lines, 500)
+                if not chunk:
+                    break
+                self.write(chunk)
+                yield self.flush()
+        finally:
+            lines.close()
+            records.close()
+        self.finish()
+
+
+class LibraryLiveHandler(tornado.websocket.WebSocketHandler):
+    """Sends the viewers of a library the changes of its main line as they are saved.
+    """
+    def initialize(self):
+        self.library_id = None
+
+    def open(self, *args, **kwargs):
+        library_id = self.get_argument('id', '')
+        if not ObjectId.is_valid(library_id):
+            return self.close()
+        self.library_id = library_id
+        live.subscribe(self.library_id, self.send_update)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        if self.library_id is not None:
+            live.unsubscribe(self.library_id, self.send_update)
+
+    def send_update(self, update):
+        try:
+            self.write_message(update)
+        except tornado.websocket.WebSocketClosedError:
+            pass
 
 
 class LibraryHotKeywordListHandler(PageHandler):
+    @check_modified(generation_version('HotKeyword'), per_user=True)
+    @cache_page('HotKeyword', per_user=True)
+    @gen.coroutine
     def get(self, *args, **kwargs):
-        session = self.get_session()
-        hot_keywords = HotKeyword.objects()
+        session = yield self.get_session_async()
+        hot_keywords = yield run_in_executor(list, HotKeyword.objects())
         return self.render('library/hot_keyword_list.html',
                            session=session, hotKeywords=hot_keywords, can_edit=session and 'root' in session['permissions'])
 
@@ -107,5 +334,8 @@ __page_handlers__ = [
     (r'^/library/searchText$', LibrarySearchTextHandler),
     (r'^/library/searchManual$', LibrarySearchManualHandler),
     (r'^/library/viewOrEdit$', LibraryViewOrEditHandler),
+    (r'^/library/boardImage$', LibraryBoardImageHandler),
+    (r'^/library/export$', LibraryExportHandler),
+    (r'^/library/live$', LibraryLiveHandler),
     (r'^/library/hotKeywordList$', LibraryHotKeywordListHandler)
 ]
@@ -0,0 +1,139 @@
+import json
+import logging
+import time
+from threading import Thread, Lock
+
+import redis
+from tornado.ioloop import IOLoop
+from tornado.options import options
+
+from library.manual import main_line
+
+
+#
+# Saves are published on one channel per library. Each process holds a single pattern subscription, read by a thread,
+# and hands the updates to the IOLoop, which writes them to the WebSocket connections of the process. So the work
+# done per save grows with the number of processes, not with the number of viewers.
+#
+_CHANNEL_PREFIX = 'library_live:'
+_RECONNECT_INTERVAL = 1
+
+_redis_pubsub_pool = redis.ConnectionPool(host=options.redis_pubsub_host,
+                                          port=options.redis_pubsub_port,
+                                          socket_timeout=options.redis_pubsub_timeout)
+
+
+class _LiveChannels:
+    """The viewers of each library connected to this process, and the thread listening to the saves.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.subscribers = dict()
+        self.io_loop = None
+        self.thread = None
+
+    def subscribe(self, library_id, callback):
+        """Must be called on the IOLoop, the callback is called there with each update of the library as JSON.
+        """
+        with self.lock:
+            if self.thread is None:
+                # Started lazily so that each forked process gets its own thread.
+                self.io_loop = IOLoop.current()
+                self.thread = Thread(target=self._listen, name='library-live', daemon=True)
+                self.thread.start()
+            self.subscribers.setdefault(library_id, set()).add(callback)
+
+    def unsubscribe(self, library_id, callback):
+        with self.lock:
+            callbacks = self.subscribers.get(library_id)
+            if callbacks is None:
+                return
+            callbacks.discard(callback)
+            if not callbacks:
+                del self.subscribers[library_id]
+
+    def _listen(self):
+        while True:
+            try:
+                # Waiting for messages must not time out, so this connection does not come from the pool.
+                redis_client = redis.StrictRedis(host=options.redis_pubsub_host, port=options.redis_pubsub_port,
+                                                 socket_keepalive=True)
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe('{0}*'.format(_CHANNEL_PREFIX))
+                for message in pubsub.listen():
+                    library_id = message['channel'].decode()[len(_CHANNEL_PREFIX):]
+                    if library_id in self.subscribers:
+                        self.io_loop.add_callback(self._dispatch, library_id, message['data'].decode())
+            except:
+                logging.exception('Failed to listen to library updates.')
+                time.sleep(_RECONNECT_INTERVAL)
+
+    def _dispatch(self, library_id, update):
+        with self.lock:
+            callbacks = list(self.subscribers.get(library_id, ()))
+        for callback in callbacks:
+            callback(update)
+
+
+def publish(library_id, update):
+    """Send an update of a library, given as a JSON-serializable dict, to its viewers in all processes.
+    """
+    redis_client = redis.StrictRedis(connection_pool=_redis_pubsub_pool)
+    redis_client.publish('{0}{1}'.format(_CHANNEL_PREFIX, library_id),
+                         json.dumps(update, ensure_ascii=False, separators=(',', ':')))
+
+
+def subscribe(library_id, callback):
+    _channels.subscribe(library_id, callback)
+
+
+def unsubscribe(library_id, callback):
+    _channels.unsubscribe(library_id, callback)
+
+
+def main_line_update(library, update_time, old_manual, manual):
+    """Returns the update sent to viewers when a library is saved: its names and update time in milliseconds, and
+    the moves of the main line following the first 'keep' ones, which are unchanged.
+
+    'appended' tells whether the save only appended moves to the main line, otherwise the variations viewers have
+    not loaded yet may have moved, see 'trim_manual'.
+    """
+    old_moves, moves, keep = _main_line(old_manual), _main_line(manual), 0
+    while keep < min(len(old_moves), len(moves)) and old_moves[keep] == moves[keep]:
+        keep += 1
+    return {'title': library.title,
+            'blackPlayerName': library.blackPlayerName,
+            'whitePlayerName': library.whitePlayerName,
+            'updateTime': update_time,
+            'appended': len(moves) >= len(old_moves) and _is_appended(old_manual, manual, len(old_moves)),
+            'keep': keep,
+            'moves': [{'x': x, 'y': y, 'm': 1, 'l': label, 'c': comment, 'd': []}
+                      for x, y, label, comment in moves[keep:]]}
+
+
+def _is_appended(old_manual, manual, length):
+    """Returns whether the manual has the moves of the old one at the same paths, and other moves only after the end
+    of the main line of the old manual, 'length' moves long. Labels and comments are not compared.
+    """
+    old_end, end = old_manual, manual
+    for _ in range(length):
+        old_end = next(descendant for descendant in old_end['d'] if descendant['m'])
+        end = next(descendant for descendant in end['d'] if descendant['m'])
+    if len(end['d']) > len(old_end['d']) + 1:
+        return False
+    stack = [(old_manual, manual)]
+    while stack:
+        old_move, move = stack.pop()
+        descendants = move['d'][:len(old_end['d'])] if move is end else move['d']
+        if (old_move.get('x'), old_move.get('y'), old_move.get('m'), len(old_move['d'])) != \
+                (move['x'], move['y'], move['m'], len(descendants)):
+            return False
+        stack.extend(zip(old_move['d'], descendants))
+    return True
+
+
+def _main_line(manual):
+    return [(move['x'], move['y'], move['l'] or '', move['c'] or '') for move in main_line(manual)]
+
+
+_channels = _LiveChannels()
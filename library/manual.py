@@ -0,0 +1,354 @@
+from random import Random
+
+
+NUM_LINES = 15
+
+#
+# The seed must never change, otherwise all the stored position hashes become invalid.
+#
+ZOBRIST_SEED = 15 * 15
+
+#
+# Neither EmbeddedDocument nor DictField work when the depth of moves is too deep, so a manual is stored packed:
+# 2 bytes per move in pre-order, the point (y * NUM_LINES + x, or PASS_POINT for the root and pass moves) and the
+# flags below. Labels and comments of the moves having them are stored in side tables, in the same order.
+#
+PASS_POINT = 0xff
+MOVE_MAJOR, MOVE_LABEL, MOVE_COMMENT, MOVE_CHILD, MOVE_SIBLING = 0x01, 0x02, 0x04, 0x08, 0x10
+
+#
+# A line cannot be longer than a full board and a few pass moves, which also keeps manuals shallow enough to be
+# encoded and decoded recursively, as JSON and by the viewer.
+#
+MAX_DEPTH = NUM_LINES * NUM_LINES + 15
+
+
+class InvalidManual(Exception):
+    pass
+
+
+class ManualSummary:
+    """Everything the save path needs to know about a manual, collected in a single walk.
+
+    packed_manual, labels, comments: the packed manual and its side tables
+    node_count: number of moves, including the root
+    depth: length of the longest line
+    patterns: position hashes, shallower positions first
+    openings: set of (position hash, canonical point of the next move), see 'canonical_position'
+    """
+    def __init__(self, packed_manual, labels, comments, node_count, depth, patterns, openings):
+        self.packed_manual = packed_manual
+        self.labels = labels
+        self.comments = comments
+        self.node_count = node_count
+        self.depth = depth
+        self.patterns = patterns
+        self.openings = openings
+
+
+def walk_manual(manual, max_nodes, max_patterns):
+    """Validate a manual given as a tree of {x, y, m, l, c, d} dicts, pack it and extract its positions.
+
+    The tree is walked once with an explicit stack, so the work is linear in the number of moves whatever the depth.
+    A position reached by transposition is kept once, and at most 'max_patterns' positions are kept.
+    Moves on occupied points and lines longer than MAX_DEPTH are rejected.
+    """
+    packed_manual, labels, comments, depths, openings = bytearray(), list(), list(), dict(), set()
+    # The occupied points of a line are kept as the bits of an int, which is cheap to copy to each descendant.
+    node_count, max_depth, stack = 0, 0, [(manual, 0, _EMPTY_HASHES, 0, False)]
+    while stack:
+        move, depth, hashes, occupied, has_sibling = stack.pop()
+        node_count += 1
+        if node_count > max_nodes:
+            raise InvalidManual('Too many moves.')
+        if depth > MAX_DEPTH:
+            raise InvalidManual('Too long line.')
+        x, y, major, label, comment, descendants = _validate_move(move, depth == 0)
+        point = PASS_POINT if x < 0 else y * NUM_LINES + x
+        if point != PASS_POINT:
+            if occupied & (1 << point):
+                raise InvalidManual('Occupied point ({0}, {1}).'.format(x, y))
+            occupied |= 1 << point
+        # Position.
+        if depth > 0:
+            openings.add((_to_int64(min(hashes)), _canonical_point(hashes, point)))
+            hashes = _play(hashes, depth - 1, x, y)
+            pattern = _to_int64(min(hashes))
+            if depths.get(pattern, depth) >= depth:
+                depths[pattern] = depth
+        max_depth = max(max_depth, depth)
+        # Packed move.
+        flags = (MOVE_MAJOR if major else 0) | (MOVE_CHILD if descendants else 0) | (MOVE_SIBLING if has_sibling else 0)
+        if label:
+            flags |= MOVE_LABEL
+            labels.append(label)
+        if comment:
+            flags |= MOVE_COMMENT
+            comments.append(comment)
+        packed_manual.append(point)
+        packed_manual.append(flags)
+        stack.extend((descendants[i], depth + 1, hashes, occupied, i < len(descendants) - 1)
+                     for i in range(len(descendants) - 1, -1, -1))
+    return ManualSummary(bytes(packed_manual), labels, comments, node_count, max_depth,
+                         _shallowest_first(depths, max_patterns), openings)
+
+
+def unpack_manual(packed_manual, labels, comments):
+    """Returns the manual as a tree of {x, y, m, l, c, d} dicts.
+    """
+    labels, comments = iter(labels), iter(comments)
+    root, parent, pending_parents = None, None, list()
+    for i in range(0, len(packed_manual), 2):
+        point, flags = packed_manual[i], packed_manual[i + 1]
+        move = {'x': -1 if point == PASS_POINT else point % NUM_LINES,
+                'y': -1 if point == PASS_POINT else point // NUM_LINES,
+                'm': 1 if flags & MOVE_MAJOR else 0,
+                'l': next(labels) if flags & MOVE_LABEL else '',
+                'c': next(comments) if flags & MOVE_COMMENT else '',
+                'd': list()}
+        if root is None:
+            root = move
+        else:
+            parent['d'].append(move)
+        if flags & MOVE_SIBLING:
+            pending_parents.append(parent)
+        if flags & MOVE_CHILD:
+            parent = move
+        elif pending_parents:
+            parent = pending_parents.pop()
+    return root
+
+
+def main_line(manual):
+    """Returns the moves of the main line of a manual given as a tree of {x, y, m, l, c, d} dicts, without the root.
+    """
+    moves, move = list(), manual
+    while True:
+        move = next((descendant for descendant in move['d'] if descendant['m']), None)
+        if move is None:
+            return moves
+        moves.append(move)
+
+
+def apply_patch(manual, operations):
+    """Apply operations to a manual given as a tree of {x, y, m, l, c, d} dicts, in place, and return the manual.
+
+    Each operation is a dict with an 'op' and a 'path', the indexes of the descendants leading from the root to a move:
+    'add' appends the move {x, y} to the descendants of the move, and makes it the end of the main line
+    'select' makes the move the end of the main line
+    'delete' deletes the move and its descendants, or all the moves if the path is empty
+    'set' sets the label 'l' and the comment 'c' of the move
+    The manual is not validated here, it is when the patched manual is walked.
+    """
+    if not isinstance(operations, list):
+        raise InvalidManual('Invalid operations.')
+    for operation in operations:
+        try:
+            op, path = operation['op'], operation['path']
+            parent, move = _find_move(manual, path)
+            if op == 'add':
+                move['d'].append({'x': operation['x'], 'y': operation['y'], 'm': 1, 'l': '', 'c': '', 'd': list()})
+                _select_line(manual, path + [len(move['d']) - 1])
+            elif op == 'select':
+                _select_line(manual, path)
+            elif op == 'delete':
+                if parent is None:
+                    move['d'] = list()
+                else:
+                    del parent['d'][path[-1]]
+            elif op == 'set':
+                move['l'], move['c'] = operation.get('l', move['l']), operation.get('c', move['c'])
+            else:
+                raise InvalidManual('Invalid operation {0}.'.format(op))
+        except (TypeError, KeyError, IndexError):
+            raise InvalidManual('Invalid operation.')
+    return manual
+
+
+def trim_manual(move):
+    """Returns a copy of a move keeping only its line, made of the major descendant of each move, or of the first one
+    if none is major.
+
+    The other descendants are kept without their own descendants, marked with 's': 1 if they have any, so that
+    viewers get the main line at once and load the variations they open with 'subtree'.
+    """
+    trimmed_move = _stub(move)
+    line_move, trimmed_line_move = move, trimmed_move
+    while line_move['d']:
+        next_move = next((descendant for descendant in line_move['d'] if descendant['m']), line_move['d'][0])
+        trimmed_line_move.pop('s')
+        trimmed_line_move['d'] = [_stub(descendant) for descendant in line_move['d']]
+        trimmed_line_move = trimmed_line_move['d'][line_move['d'].index(next_move)]
+        line_move = next_move
+    return trimmed_move
+
+
+def subtree(manual, path):
+    """Returns the trimmed move at the given path, see 'trim_manual' and 'apply_patch'.
+    """
+    try:
+        return trim_manual(_find_move(manual, path)[1])
+    except (TypeError, IndexError):
+        raise InvalidManual('Invalid path.')
+
+
+def position_hashes(moves):
+    """Returns one hash per ply, each hash is the smallest among the hashes of the 8 symmetric variants of the position.
+
+    The hashes are converted to signed 64-bit integers so that they can be stored as MongoDB longs.
+    """
+    hashes, result = _EMPTY_HASHES, list()
+    for ply, (x, y) in enumerate(moves):
+        hashes = _play(hashes, ply, x, y)
+        result.append(_to_int64(min(hashes)))
+    return result
+
+
+def canonical_position(moves):
+    """Returns the hash of the position reached by the given moves, and a transform turning it into its canonical form.
+
+    Next moves are recorded in the canonical form of a position, see 'ManualSummary.openings', and can be brought
+    back to the orientation of the given moves with 'untransform_point'.
+    """
+    hashes = _EMPTY_HASHES
+    for ply, (x, y) in enumerate(moves):
+        hashes = _play(hashes, ply, x, y)
+    minimum = min(hashes)
+    return _to_int64(minimum), hashes.index(minimum)
+
+
+def untransform_point(point, transform):
+    """Returns the (x, y) of a point in the canonical form of a position, in the orientation of the position.
+    """
+    if point == PASS_POINT:
+        return -1, -1
+    point = _transformed_points[_inverse_transforms[transform]][point]
+    return point % NUM_LINES, point // NUM_LINES
+
+
+def transform_point(x, y, transform):
+    """Apply one of the 8 board symmetries, transforms 0-3 are rotations and 4-7 are reflected rotations.
+    """
+    for _ in range(transform % 4):
+        x, y = NUM_LINES - 1 - y, x
+    if transform >= 4:
+        x = NUM_LINES - 1 - x
+    return x, y
+
+
+def _find_move(manual, path):
+    """Returns the parent of the move at the given path, None for the root, and the move.
+    """
+    parent, move = None, manual
+    for index in path:
+        if type(index) is not int or index < 0:
+            raise InvalidManual('Invalid path.')
+        parent, move = move, move['d'][index]
+    return parent, move
+
+
+def _stub(move):
+    stub = {'x': move['x'], 'y': move['y'], 'm': move['m'], 'l': move['l'], 'c': move['c'], 'd': list()}
+    if move['d']:
+        stub['s'] = 1
+    return stub
+
+
+def _select_line(manual, path):
+    """Mark the moves leading to the given path as major, and the other lines starting from them as variants.
+    """
+    move = manual
+    for index in path:
+        for i, descendant in enumerate(move['d']):
+            if i != index and descendant['m']:
+                stack = [descendant]
+                while stack:
+                    variant = stack.pop()
+                    variant['m'] = 0
+                    stack.extend(variant['d'])
+        move = move['d'][index]
+        move['m'] = 1
+
+
+def _validate_move(move, is_root):
+    """Returns the fields of a move, raises InvalidManual if the move is malformed.
+    """
+    try:
+        x, y, major, label, comment, descendants = move['x'], move['y'], move['m'], move['l'], move['c'], move['d']
+    except (TypeError, KeyError):
+        raise InvalidManual('Invalid move.')
+    if type(x) is not int or type(y) is not int:
+        raise InvalidManual('Invalid move.')
+    if not (0 <= x < NUM_LINES and 0 <= y < NUM_LINES) and (x, y) != (-1, -1) or is_root and (x, y) != (-1, -1):
+        raise InvalidManual('Invalid move ({0}, {1}).'.format(x, y))
+    if major not in (0, 1) or not isinstance(descendants, list):
+        raise InvalidManual('Invalid move ({0}, {1}).'.format(x, y))
+    if label is not None and not isinstance(label, str) or comment is not None and not isinstance(comment, str):
+        raise InvalidManual('Invalid move ({0}, {1}).'.format(x, y))
+    return x, y, major, label, comment, descendants
+
+
+#
+# Transformed points indexed by [transform][y * NUM_LINES + x], and the inverse of each transform.
+#
+_transformed_points = [[y * NUM_LINES + x for x, y in (transform_point(i % NUM_LINES, i // NUM_LINES, transform)
+                                                       for i in range(NUM_LINES * NUM_LINES))]
+                       for transform in range(8)]
+
+_inverse_transforms = [[inverse for inverse in range(8)
+                        if _transformed_points[inverse][_transformed_points[transform][1]] == 1 and
+                        _transformed_points[inverse][_transformed_points[transform][NUM_LINES]] == NUM_LINES][0]
+                       for transform in range(8)]
+
+
+def _generate_zobrist_keys():
+    """Returns 64-bit random keys indexed by [stone][transform][y * NUM_LINES + x].
+
+    The keys of a transform are the keys of the transformed points, so hashing a position with each transform
+    gives the hashes of its 8 symmetric variants.
+    """
+    random, num_points = Random(ZOBRIST_SEED), NUM_LINES * NUM_LINES
+    keys = [[random.getrandbits(64) for _ in range(num_points)] for _ in range(2)]
+    return [[[stone_keys[index] for index in points] for points in _transformed_points] for stone_keys in keys]
+
+
+_zobrist_keys = _generate_zobrist_keys()
+
+_EMPTY_HASHES = (0, ) * 8
+
+
+def _play(hashes, ply, x, y):
+    """Returns the hashes of the 8 symmetric variants after playing the move of the given 0-based ply.
+
+    Pass moves are given as (-1, -1), they change the stone to play but not the position.
+    """
+    if not (0 <= x < NUM_LINES and 0 <= y < NUM_LINES):
+        return hashes
+    stone_keys, index = _zobrist_keys[ply % 2], y * NUM_LINES + x
+    return tuple(hashes[transform] ^ stone_keys[transform][index] for transform in range(8))
+
+
+def _canonical_point(hashes, point):
+    """Returns the point transformed to the canonical form of the position, the smallest one if the position is
+    symmetric and several transforms lead to the canonical form.
+    """
+    if point == PASS_POINT:
+        return PASS_POINT
+    minimum = min(hashes)
+    return min(_transformed_points[transform][point] for transform in range(8) if hashes[transform] == minimum)
+
+
+def _shallowest_first(depths, limit):
+    """Returns at most 'limit' patterns ordered by depth, using a bucket per depth to stay linear.
+    """
+    patterns_by_depth = dict()
+    for pattern, depth in depths.items():
+        patterns_by_depth.setdefault(depth, list()).append(pattern)
+    patterns = list()
+    for depth in sorted(patterns_by_depth):
+        patterns.extend(patterns_by_depth[depth])
+    return patterns[:limit]
+
+
+def _to_int64(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
@@ -1,97 +1,482 @@
-from mongoengine.fields import StringField, DictField, ListField
+import logging
+from collections import Counter
+from datetime import datetime
 
-from core.models import BaseModel
+from mongoengine import Document
+from mongoengine.fields import StringField, DictField, ListField, LongField, BinaryField, IntField
+from bson import ObjectId
+from pymongo import UpdateOne
+from tornado.options import options
 
+from core.models import BaseModel, OutdatedDocument, to_milliseconds
+from core.utils.executor import run_in_executor
+from core.utils.cache import increase_generation
+from library import position_index, autocomplete, live, board_image
+from library.manual import InvalidManual, walk_manual, unpack_manual, main_line, apply_patch, subtree, position_hashes,\
+    canonical_position, untransform_point
+
+
+_MANUAL_FIELDS = ('manual', 'packedManual', 'manualLabels', 'manualComments')
 
 #
-# The EmbeddedDocument won't work when the depth of moves is too deep.
-#
-# class Move(EmbeddedDocument):
-#     x = IntField(db_field='x')
-#     y = IntField(db_field='y')
-#     is_major = IntField(db_field='m')
-#     label = StringField(db_field='l')
-#     comment = StringField(db_field='c')
-#     descendants = ListField(EmbeddedDocumentField('Move'), db_field='d')
+# Search results show the matching fragments of the comments rather than the comments.
 #
+_COMMENT_HIGHLIGHT = {'encoder': 'html',
+                      'fields': {'_comments': {'fragment_size': 60, 'number_of_fragments': 2}}}
 
 
 class Library(BaseModel):
     title = StringField(max_length=40)
     blackPlayerName = StringField(max_length=40)
     whitePlayerName = StringField(max_length=40)
-    manual = DictField(required=True)
-    patterns = ListField(StringField())
+    manual = DictField()
+    packedManual = BinaryField()
+    manualLabels = ListField(StringField())
+    manualComments = ListField(StringField())
+    patterns = ListField(LongField())
     meta = {
-        'indexes': ['-updateTime', ('patterns', '-updateTime')],
+        'indexes': [('-updateTime', '-id'), ('patterns', '-updateTime', '-id')],
         'ordering': ['-updateTime']
     }
+    search_mapping = {
+        'properties': {
+            '_positions': {'type': 'long'}
+        }
+    }
 
     @classmethod
-    def clean_attributes(cls, **attributes):
-        if 'manual' in attributes:
-            attributes['patterns'] = Library.__extract_patterns(attributes['manual'])
-        return attributes
+    def save_and_index(cls, user=None, id=None, manual=None, **attributes):
+        """Walk the manual once to store it packed with its patterns, then update the position index and the
+        opening statistics, and send the changes of the main line to the viewers of the library.
+        """
+        old_library = Library.objects(id=id).only('patterns', 'title', 'blackPlayerName', 'whitePlayerName',
+                                                  *_MANUAL_FIELDS).first() if id else None
+        summary = Library.__walk_manual(manual) if manual is not None else None
+        if summary is not None:
+            # The old manual is walked before saving, so that nothing fails once the library is saved.
+            old_manual = old_library.get_manual() if old_library else {'d': []}
+            old_openings = Library.__openings_of(old_manual) if old_library else set()
+            attributes.update(manual=None, patterns=summary.patterns, packedManual=summary.packed_manual,
+                              manualLabels=summary.labels, manualComments=summary.comments)
+        library = super().save_and_index(user, id=id, **attributes)
+        position_index.record_saved(library.id, to_milliseconds(library.updateTime),
+                                    library.patterns, old_library.patterns if old_library else ())
+        if summary is not None:
+            OpeningStat.update_counts(old_openings, summary.openings)
+            Library.__publish_live(library, old_manual, manual)
+        names = library.__names()
+        if old_library:
+            names.subtract(old_library.__names())
+        Library.__update_autocomplete(names)
+        return library
 
-    def to_vo(self, search=False, **kwargs):
+    @staticmethod
+    def patch_manual(user, id, update_time, operations, **attributes):
+        """Apply patch operations to the manual of a library, see 'apply_patch', and save it with other attributes.
+
+        'update_time' is the update time in milliseconds of the library the operations were made on, OutdatedDocument
+        is raised if the library has been saved since then, so that concurrent editors do not overwrite each other.
+        """
+        library = Library.objects(id=id).only('updateTime', *_MANUAL_FIELDS).first()
+        if library is None or to_milliseconds(library.updateTime) != update_time:
+            raise OutdatedDocument('The library being patched does not exist or is out dated.')
+        manual = apply_patch(library.get_manual(), operations)
+        return Library.save_and_index(user, id=id, old_update_time=library.updateTime, manual=manual, **attributes)
+
+    @staticmethod
+    def patch_manual_async(*args, **kwargs):
+        """Coroutine version of the 'patch_manual' method.
+        """
+        return run_in_executor(Library.patch_manual, *args, **kwargs)
+
+    def delete(self, **write_concern):
+        super().delete(**write_concern)
+        position_index.record_deleted(self.id, self.patterns or ())
+        OpeningStat.update_counts(Library.__openings_of(self.get_manual()), set())
+        names = Counter()
+        names.subtract(self.__names())
+        Library.__update_autocomplete(names)
+
+    def to_vo(self, search=False, detail=False, **kwargs):
         vo = super().to_vo(**kwargs)
         vo['title'] = self.title
         vo['blackPlayerName'] = self.blackPlayerName
         vo['whitePlayerName'] = self.whitePlayerName
-        if search:
-            descendants = [descendant for descendant in self.manual['d']]
-            comments = [] if not self.manual['c'] else [self.manual['c']]
-            while descendants:
-                descendant = descendants.pop()
-                if descendant['c']:
-                    comments.append(descendant['c'])
-                if descendant['d']:
-                    descendants.extend(descendant['d'])
-            vo['_comments'] = comments
+        if detail:
+            vo['manual'] = self.get_manual()
+        if search and self.packedManual is not None:
+            vo['_comments'] = list(self.manualComments)
+        elif search:
+            summary = Library.__walk_stored_manual(self)
+            vo['_comments'] = summary.comments if summary is not None else list()
         return vo
 
     def to_search_doc(self):
-        return self.to_vo(search=True)
-
-    @staticmethod
-    def list_by_page(page_num, page_size=10):
-        libraries = Library.objects.exclude('manual', 'patterns')
-        return Library.paginate_query_set(libraries, page_num, page_size)
-
-    @staticmethod
-    def search_text_by_page(keyword, page_num, page_size=10):
-        query = {'multi_match': {'query': keyword,
-                                 'fields': ['title^2',
-                                            'blackPlayerName^2',
-                                            'whitePlayerName^2',
-                                            '_comments']}}
-        return Library.do_search(query, page_num, page_size)
-
-    @staticmethod
-    def search_manual_by_page(search_datas, page_num, page_size=10):
-        libraries = Library.objects(patterns__in=search_datas).exclude('manual', 'patterns')
-        return Library.paginate_query_set(libraries, page_num, page_size)
-
-    @staticmethod
-    def __extract_patterns(manual):
-        descendants, max_length, part1, part2 = manual['d'], 30, list(), list()
-        patterns = ['' for _ in range(max_length)]
-        for i in range(max_length):
-            major_found = False
-            for descendant in descendants:
-                if descendant['m'] == 1:
-                    if i % 2 == 0:
-                        part1.append('|{0}_{1}'.format(descendant['x'], descendant['y']))
-                        part1.sort()
-                    else:
-                        part2.append('|{0}_{1}'.format(descendant['x'], descendant['y']))
-                        part2.sort()
-                    patterns[i] = ''.join(part1) + ''.join(part2)
-                    major_found, descendants = True, descendant['d']
-                    break
-            if not major_found:
-                break
-        return patterns
+        search_doc = self.to_vo(search=True)
+        search_doc['_positions'] = list(self.patterns or ())
+        return search_doc
+
+    def get_manual(self):
+        """Returns the manual as a tree of {x, y, m, l, c, d} dicts, whether it is stored packed or not.
+        """
+        if self.packedManual is None:
+            return self.manual
+        return unpack_manual(self.packedManual, self.manualLabels, self.manualComments)
+
+    @staticmethod
+    def get_subtree(id, update_time, path):
+        """Returns the move at the given path of the manual of a library, trimmed to its line, see 'trim_manual'.
+
+        'update_time' is the update time in milliseconds of the library the path was taken from, OutdatedDocument is
+        raised if the library has been saved since then, as the path may lead to another move.
+        """
+        library = Library.objects(id=id).only('updateTime', *_MANUAL_FIELDS).first()
+        if library is None or to_milliseconds(library.updateTime) != update_time:
+            raise OutdatedDocument('The library does not exist or is out dated.')
+        return subtree(library.get_manual(), path)
+
+    @staticmethod
+    def get_subtree_async(id, update_time, path):
+        """Coroutine version of the 'get_subtree' method.
+        """
+        return run_in_executor(Library.get_subtree, id, update_time, path)
+
+    @staticmethod
+    def get_board_image(id, update_time, ply=-1, size=board_image.SIZE):
+        """Returns the PNG of the main line position of a library after 'ply' moves, or after all of them if 'ply' is
+        negative, None if the library does not exist.
+
+        Images are cached on disk by library, update time in milliseconds, ply and size.
+        """
+        image = board_image.get_cached(id, update_time, ply, size)
+        if image is not None:
+            return image
+        library = Library.objects(id=id).only('updateTime', *_MANUAL_FIELDS).first()
+        if library is None:
+            return None
+        moves = [(move['x'], move['y']) for move in main_line(library.get_manual())]
+        if ply < 0 or ply >= len(moves):
+            # All the plies past the end show the final position, which is cached once.
+            ply = -1
+            image = board_image.get_cached(id, update_time, ply, size)
+            if image is not None:
+                return image
+        image = board_image.render(moves[:ply] if ply >= 0 else moves, size)
+        board_image.set_cached(id, to_milliseconds(library.updateTime), ply, size, image)
+        return image
+
+    @staticmethod
+    def get_board_image_async(id, update_time, ply=-1, size=board_image.SIZE):
+        """Coroutine version of the 'get_board_image' method.
+        """
+        return run_in_executor(Library.get_board_image, id, update_time, ply, size)
+
+    @staticmethod
+    def list_by_cursor(cursor, page_size=10):
+        """Returns the libraries of a page, the cursor of the next page, and the approximate number of libraries.
+        """
+        libraries = Library.objects.exclude('patterns', *_MANUAL_FIELDS)
+        libraries, next_cursor = Library.paginate_query_set_by_cursor(libraries, cursor, page_size)
+        # Counting without a filter reads the collection metadata.
+        return libraries, next_cursor, Library._get_collection().count()
+
+    @staticmethod
+    def list_by_cursor_async(cursor, page_size=10):
+        """Coroutine version of the 'list_by_cursor' method.
+        """
+        return run_in_executor(Library.list_by_cursor, cursor, page_size)
+
+    @staticmethod
+    def search_text_by_page(keyword, page_num, page_size=10, moves=None):
+        """Search by keyword, and by the position reached by the given moves if any, in a single query.
+        """
+        if keyword:
+            query = {'multi_match': {'query': keyword,
+                                     'fields': ['title^2',
+                                                'blackPlayerName^2',
+                                                'whitePlayerName^2',
+                                                '_comments']}}
+        else:
+            query = {'match_all': {}}
+        pattern = Library.normalize_moves(moves) if moves else None
+        if pattern is not None:
+            query = {'bool': {'must': query, 'filter': {'term': {'_positions': pattern}}}}
+        return Library.do_search(query, page_num, page_size,
+                                 source=['title', 'blackPlayerName', 'whitePlayerName'],
+                                 highlight=_COMMENT_HIGHLIGHT if keyword else None,
+                                 cache_expire_after=options.search_cache_expire_after)
+
+    @staticmethod
+    def search_text_by_page_async(keyword, page_num, page_size=10, moves=None):
+        """Coroutine version of the 'search_text_by_page' method.
+        """
+        return run_in_executor(Library.search_text_by_page, keyword, page_num, page_size, moves)
+
+    @staticmethod
+    def search_manual_by_cursor(moves, cursor, page_size=10):
+        """Returns the libraries of a page, the cursor of the next page, and the number of libraries containing the
+        position, which is None when the position index file is not built yet.
+        """
+        pattern = Library.normalize_moves(moves)
+        if pattern is None:
+            return list(), None, 0
+        libraries, total_count = Library.objects.exclude('patterns', *_MANUAL_FIELDS), position_index.count(pattern)
+        # The cursor comes from the index records rather than from the libraries, they may have been updated since.
+        # The index file may also stop being used between the count and the lookup, see 'position_index'.
+        records = None
+        if total_count is not None:
+            records = position_index.lookup(pattern, page_size + 1, Library.decode_page_cursor(cursor))
+        if records is None:
+            libraries, next_cursor = Library.paginate_query_set_by_cursor(libraries.filter(patterns=pattern),
+                                                                          cursor, page_size)
+            return libraries, next_cursor, None
+        next_cursor = Library.encode_page_cursor(*records[page_size - 1]) if len(records) > page_size else None
+        ids = [library_id for _, library_id in records[:page_size]]
+        documents = {document.id: document for document in libraries.filter(id__in=ids)}
+        return [documents[id] for id in ids if id in documents], next_cursor, total_count
+
+    @staticmethod
+    def search_manual_by_cursor_async(moves, cursor, page_size=10):
+        """Coroutine version of the 'search_manual_by_cursor' method.
+        """
+        return run_in_executor(Library.search_manual_by_cursor, moves, cursor, page_size)
+
+    @staticmethod
+    def normalize_moves(moves):
+        """Returns the canonical hash of the position reached by the given moves, in any orientation.
+
+        Clients send their moves as they see them on the board, the server takes care of reflections and rotations.
+        """
+        patterns = position_hashes([(int(x), int(y)) for x, y in moves])
+        return patterns[-1] if patterns else None
+
+    @staticmethod
+    def bulk_import(user, games, batch_size=1000):
+        """Import games given as dicts of Library attributes, as yielded by 'library.records.read_records'.
+
+        Games are written in batches, with one MongoDB insert and one elasticsearch bulk request per batch, so
+        the memory use stays flat whatever the number of games. Returns the number of imported games.
+        """
+        imported_count, batch = 0, list()
+        for game in games:
+            batch.append(game)
+            if len(batch) >= batch_size:
+                imported_count += Library.__insert_batch(user, batch)
+                batch.clear()
+        if batch:
+            imported_count += Library.__insert_batch(user, batch)
+        increase_generation(Library.__name__)
+        Library.build_position_index()
+        return imported_count
+
+    @staticmethod
+    def export_records(batch_size=500):
+        """Yields all libraries one at a time as dicts of Library attributes, oldest first.
+
+        The libraries are read from a server-side cursor, so the memory use stays flat whatever their number.
+        """
+        libraries = Library.objects.exclude('patterns').order_by('_id').batch_size(batch_size).no_cache().\
+            timeout(False)
+        for library in libraries:
+            yield {'id': str(library.id),
+                   'createTime': to_milliseconds(library.createTime),
+                   'updateTime': to_milliseconds(library.updateTime),
+                   'title': library.title or '',
+                   'blackPlayerName': library.blackPlayerName or '',
+                   'whitePlayerName': library.whitePlayerName or '',
+                   'manual': library.get_manual()}
+
+    @staticmethod
+    def export_player_names():
+        """Returns the sorted names of all players, needed before the games in some export formats.
+        """
+        collection = Library._get_collection()
+        names = set(collection.distinct('blackPlayerName')) | set(collection.distinct('whitePlayerName'))
+        return sorted(name for name in names if name)
+
+    @staticmethod
+    def build_autocomplete():
+        """Rebuild the prefix index of player names and titles used by autocomplete.
+        """
+        autocomplete.clear()
+        names = Counter()
+        for library in Library.objects.only('title', 'blackPlayerName', 'whitePlayerName').no_cache().timeout(False):
+            names.update(library.__names())
+            if len(names) >= 10000:
+                autocomplete.update_counts(names)
+                names.clear()
+        autocomplete.update_counts(names)
+
+    @staticmethod
+    def rebuild_patterns():
+        """Recalculate the patterns of all libraries, the update time is left untouched.
+        """
+        for library in Library.objects.only(*_MANUAL_FIELDS).no_cache().timeout(False):
+            summary = Library.__walk_stored_manual(library)
+            if summary is not None:
+                Library.objects(id=library.id).update_one(set__patterns=summary.patterns)
+
+    @staticmethod
+    def pack_manuals():
+        """Convert the manuals still stored as nested dicts to the packed format, the update time is left untouched.
+        """
+        for library in Library.objects(packedManual__exists=False).only('manual').no_cache().timeout(False):
+            summary = Library.__walk_stored_manual(library)
+            if summary is None:
+                continue
+            Library.objects(id=library.id).update_one(set__packedManual=summary.packed_manual,
+                                                      set__manualLabels=summary.labels,
+                                                      set__manualComments=summary.comments,
+                                                      unset__manual=True)
+
+    @staticmethod
+    def build_position_index():
+        """Rebuild the position index file used by manual search.
+        """
+        libraries = Library.objects.only('patterns', 'updateTime').no_cache().timeout(False)
+        return position_index.build(options.library_position_index_path,
+                                    ((library.id, to_milliseconds(library.updateTime), library.patterns)
+                                     for library in libraries))
+
+    @staticmethod
+    def rebuild_opening_stats():
+        """Recalculate the opening statistics from all libraries.
+        """
+        OpeningStat.drop_collection()
+        counts = Counter()
+        for library in Library.objects.only(*_MANUAL_FIELDS).no_cache().timeout(False):
+            summary = Library.__walk_stored_manual(library)
+            if summary is not None:
+                counts.update(summary.openings)
+            if len(counts) >= 100000:
+                OpeningStat.increase_counts(counts)
+                counts.clear()
+        OpeningStat.increase_counts(counts)
+
+    @staticmethod
+    def __insert_batch(user, games):
+        libraries, openings, now = list(), Counter(), datetime.now()
+        for game in games:
+            try:
+                summary = Library.__walk_manual(game['manual'])
+            except InvalidManual as e:
+                logging.warning('Skipped game {0}: {1}'.format(game['title'], e))
+                continue
+            library = Library(id=ObjectId(), createBy=user, updateBy=user, createTime=now, updateTime=now,
+                              title=game['title'], blackPlayerName=game['blackPlayerName'],
+                              whitePlayerName=game['whitePlayerName'], manual=None, patterns=summary.patterns,
+                              packedManual=summary.packed_manual, manualLabels=summary.labels,
+                              manualComments=summary.comments)
+            library.validate()
+            libraries.append(library)
+            openings.update(summary.openings)
+        if not libraries:
+            return 0
+        Library._get_collection().insert_many([library.to_mongo() for library in libraries], ordered=False)
+        Library.bulk_index_for_search(libraries)
+        OpeningStat.increase_counts(openings)
+        names = Counter()
+        for library in libraries:
+            names.update(library.__names())
+        Library.__update_autocomplete(names)
+        return len(libraries)
+
+    def __names(self):
+        return autocomplete.names_of(self.title, self.blackPlayerName, self.whitePlayerName)
+
+    @staticmethod
+    def __update_autocomplete(names):
+        try:
+            autocomplete.update_counts(names)
+        except:
+            logging.error('Failed to update autocomplete, run library_build_autocomplete to fix it.')
+
+    @staticmethod
+    def __publish_live(library, old_manual, manual):
+        try:
+            update = live.main_line_update(library, to_milliseconds(library.updateTime), old_manual, manual)
+            live.publish(library.id, update)
+        except:
+            logging.error('Failed to publish the update of library {0}.'.format(library.id))
+
+    @staticmethod
+    def __openings_of(manual):
+        """Returns the openings of a stored manual, which may not pass the current validation.
+        """
+        try:
+            return Library.__walk_manual(manual).openings
+        except InvalidManual:
+            logging.error('Failed to walk a stored manual, run library_rebuild_opening_stats to fix the statistics.')
+            return set()
+
+    @staticmethod
+    def __walk_stored_manual(library):
+        """Returns the summary of the manual of a stored library, None if it does not pass the current validation, as
+        older clients could save any manual.
+        """
+        try:
+            return Library.__walk_manual(library.get_manual())
+        except InvalidManual as e:
+            logging.warning('Invalid manual of library {0}: {1}'.format(library.id, e))
+            return None
+
+    @staticmethod
+    def __walk_manual(manual):
+        return walk_manual(manual, options.library_max_manual_nodes, options.library_max_patterns)
+
+
+class OpeningStat(Document):
+    """Number of libraries playing a move in a position, both in the canonical form of the position.
+
+    The statistics are kept up to date by 'Library.save_and_index' and 'Library.delete'.
+    """
+    position = LongField(required=True)
+    move = IntField(required=True)
+    count = IntField(required=True)
+    meta = {
+        'indexes': [{'fields': ['position', 'move'], 'unique': True}, ('position', '-count')]
+    }
+
+    @staticmethod
+    def explore(moves):
+        """Returns the moves played next in the position reached by the given moves, with their number of libraries.
+
+        The moves are returned in the orientation of the given moves.
+        """
+        position, transform = canonical_position([(int(x), int(y)) for x, y in moves])
+        continuations = list()
+        for stat in OpeningStat.objects(position=position).order_by('-count'):
+            x, y = untransform_point(stat.move, transform)
+            continuations.append({'x': x, 'y': y, 'count': stat.count})
+        return continuations
+
+    @staticmethod
+    def explore_async(moves):
+        """Coroutine version of the 'explore' method.
+        """
+        return run_in_executor(OpeningStat.explore, moves)
+
+    @staticmethod
+    def update_counts(old_openings, new_openings):
+        """Count a library's (position, move) pairs that are new, and stop counting the ones that are gone.
+        """
+        counts = Counter(new_openings - old_openings)
+        counts.subtract(old_openings - new_openings)
+        OpeningStat.increase_counts(counts)
+
+    @staticmethod
+    def increase_counts(counts):
+        """Apply a {(position, move): increment} dict in bulk, and remove the statistics dropping to zero.
+        """
+        operations = [UpdateOne({'position': position, 'move': move}, {'$inc': {'count': count}}, upsert=True)
+                      for (position, move), count in counts.items() if count]
+        if not operations:
+            return
+        collection = OpeningStat._get_collection()
+        collection.bulk_write(operations, ordered=False)
+        decreased_positions = list({position for (position, _), count in counts.items() if count < 0})
+        if decreased_positions:
+            collection.delete_many({'position': {'$in': decreased_positions}, 'count': {'$lte': 0}})
 
 
 class HotKeyword(BaseModel):
@@ -0,0 +1,245 @@
+import os
+import time
+import struct
+import mmap
+import heapq
+import logging
+from threading import Lock
+
+from bson import ObjectId
+from tornado.options import options
+
+
+#
+# The index file starts with a header, followed by fixed-size records sorted by position hash, then by update time
+# and library ID in descending order, which is the order search results are shown in.
+#
+_HEADER = struct.Struct('<4sIqq')
+_RECORD = struct.Struct('<qq12s')
+_MAGIC, _VERSION = b'RJPI', 1
+
+#
+# How often, in seconds, a process checks whether the index file has been rebuilt.
+#
+_CHECK_INTERVAL = 10
+
+#
+# A process changing more libraries than this since the file was built stops using it until a newer file is built,
+# manual search then falls back to MongoDB. The file is meant to be rebuilt regularly, see crontab.sample.
+#
+_MAX_DELTA_SIZE = 10000
+
+#
+# The file is built by sorting runs of this many records, written to temporary files and merged, so the memory used
+# does not grow with the number of patterns of the collection.
+#
+_BUILD_RUN_SIZE = 200000
+
+
+class _PositionIndex:
+    """A position hash -> library ID index, memory-mapped read-only so that all forked workers share one copy.
+
+    Saves and deletions made by this process since the file was built are kept in a small delta, which is merged
+    at lookup time and discarded once a newer file is found.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.file_id = None
+        self.checked_at = 0
+        self.mmap = None
+        self.build_time = 0
+        self.record_count = 0
+        self.delta = dict()
+        # Files built before this time miss changes dropped from the delta, see _MAX_DELTA_SIZE.
+        self.outdated_before = 0
+
+    def count(self, pattern):
+        """Returns the number of libraries containing the position, or None if the index file is not available.
+        """
+        with self.lock:
+            if not self._check_file():
+                return None
+            low, high = self._equal_range(pattern)
+            added = sum(1 for _, patterns, _ in self.delta.values() if pattern in patterns)
+            removed = sum(1 for _, _, old_patterns in self.delta.values() if pattern in old_patterns)
+            return max(high - low + added - removed, 0)
+
+    def lookup(self, pattern, limit, after=None):
+        """Returns (update time, library ID) of the libraries containing the position, most recently updated first.
+
+        'after' is an (update time, library ID) returned by a previous lookup, the lookup continues after it.
+        """
+        with self.lock:
+            if not self._check_file():
+                return None
+            after = (after[0], ObjectId(after[1]).binary) if after else None
+            low, high = self._equal_range(pattern)
+            if after:
+                low = self._lower_bound_after(low, high, after)
+            added = sorted(((update_time, library_id) for library_id, (update_time, patterns, _)
+                            in self.delta.items() if pattern in patterns), reverse=True)
+            if after:
+                added = [record for record in added if record < after]
+            records, i, j = list(), low, 0
+            while len(records) < limit:
+                while i < high and self._read(i)[2] in self.delta:
+                    i += 1
+                record = self._read(i)[1:] if i < high else None
+                if record is None and j >= len(added):
+                    break
+                if record is None or (j < len(added) and added[j] > record):
+                    record, j = added[j], j + 1
+                else:
+                    i += 1
+                records.append((record[0], ObjectId(record[1])))
+            return records
+
+    def record_saved(self, library_id, update_time, patterns, old_patterns):
+        with self.lock:
+            library_id = ObjectId(library_id).binary
+            if library_id in self.delta:
+                old_patterns = self.delta[library_id][2]
+            elif len(self.delta) >= _MAX_DELTA_SIZE:
+                logging.warning('Too many changes since the position index file was built, run '
+                                'library_build_position_index.')
+                self.delta.clear()
+                self.outdated_before = _now()
+            self.delta[library_id] = (update_time, frozenset(patterns), frozenset(old_patterns))
+
+    def record_deleted(self, library_id, old_patterns):
+        self.record_saved(library_id, _now(), (), old_patterns)
+
+    def _check_file(self):
+        """Maps the index file if it has been (re)built since the last check, returns whether a file is mapped and
+        can be used.
+        """
+        self._map_file()
+        return self.mmap is not None and self.build_time >= self.outdated_before
+
+    def _map_file(self):
+        now = time.time()
+        if now - self.checked_at < _CHECK_INTERVAL:
+            return
+        self.checked_at = now
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if (stat.st_ino, stat.st_mtime) == self.file_id:
+            return
+        with open(self.path, 'rb') as file:
+            new_mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, build_time, record_count = _HEADER.unpack_from(new_mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            logging.error('Invalid position index file {0}.'.format(self.path))
+            new_mmap.close()
+            return
+        if self.mmap is not None:
+            self.mmap.close()
+        self.mmap, self.file_id = new_mmap, (stat.st_ino, stat.st_mtime)
+        self.build_time, self.record_count = build_time, record_count
+        self.delta = {library_id: entry for library_id, entry in self.delta.items() if entry[0] > build_time}
+
+    def _read(self, i):
+        return _RECORD.unpack_from(self.mmap, _HEADER.size + _RECORD.size * i)
+
+    def _equal_range(self, pattern):
+        return self._lower_bound(pattern), self._lower_bound(pattern + 1)
+
+    def _lower_bound_after(self, low, high, after):
+        """Returns the first record of a position in [low, high) coming after 'after' in descending order.
+        """
+        while low < high:
+            middle = (low + high) // 2
+            if self._read(middle)[1:] >= after:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _lower_bound(self, pattern):
+        low, high = 0, self.record_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._read(middle)[0] < pattern:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+def build(path, libraries):
+    """Write a new index file from (library ID, update time, patterns) tuples, replacing the old file atomically.
+    """
+    build_time, run_paths, records, record_count = _now(), list(), list(), 0
+    try:
+        for library_id, update_time, patterns in libraries:
+            # Records are sorted by this key, IDs in descending order being the inverted IDs in ascending order.
+            library_id = _invert(ObjectId(library_id).binary)
+            records.extend((pattern, -update_time, library_id) for pattern in patterns)
+            if len(records) >= _BUILD_RUN_SIZE:
+                run_paths.append(_write_run(path, len(run_paths), records))
+                record_count += len(records)
+                records = list()
+        records.sort()
+        record_count += len(records)
+        temp_path = '{0}.tmp'.format(path)
+        with open(temp_path, 'wb') as file:
+            file.write(_HEADER.pack(_MAGIC, _VERSION, build_time, record_count))
+            for pattern, update_time, library_id in heapq.merge(records, *(_read_run(run_path)
+                                                                           for run_path in run_paths)):
+                file.write(_RECORD.pack(pattern, -update_time, _invert(library_id)))
+        os.replace(temp_path, path)
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
+    return record_count
+
+
+def _write_run(path, run_number, records):
+    records.sort()
+    run_path = '{0}.run{1}'.format(path, run_number)
+    with open(run_path, 'wb') as file:
+        for record in records:
+            file.write(_RECORD.pack(*record))
+    return run_path
+
+
+def _read_run(run_path):
+    with open(run_path, 'rb') as file:
+        while True:
+            chunk = file.read(_RECORD.size * 1024)
+            if not chunk:
+                return
+            yield from _RECORD.iter_unpack(chunk)
+
+
+def _invert(library_id):
+    return library_id.translate(_INVERTED_BYTES)
+
+
+_INVERTED_BYTES = bytes(range(255, -1, -1))
+
+
+def count(pattern):
+    return _index.count(pattern)
+
+
+def lookup(pattern, limit, after=None):
+    return _index.lookup(pattern, limit, after)
+
+
+def record_saved(library_id, update_time, patterns, old_patterns):
+    _index.record_saved(library_id, update_time, patterns, old_patterns)
+
+
+def record_deleted(library_id, old_patterns):
+    _index.record_deleted(library_id, old_patterns)
+
+
+def _now():
+    return int(time.time() * 1000)
+
+
+_index = _PositionIndex(options.library_position_index_path)
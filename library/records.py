@@ -0,0 +1,218 @@
+import os
+import re
+import json
+import logging
+from xml.etree.ElementTree import iterparse
+from xml.sax.saxutils import escape, quoteattr
+
+from library.manual import NUM_LINES
+
+
+#
+# RenLib (.lib) files hold one opening tree: a 20 bytes header, then 2 bytes per move in pre-order, the point (column
+# 1-15 in the low nibble, row 0-14 from the top in the high nibble, 0 for no move) and the flags below. Moves having
+# a comment are followed by the null-terminated comment, and extended moves by 2 more flag bytes.
+#
+_RENLIB_HEADER_LENGTH = 20
+_RENLIB_DOWN, _RENLIB_RIGHT, _RENLIB_OLD_COMMENT, _RENLIB_COMMENT, _RENLIB_EXTENSION = 0x80, 0x40, 0x20, 0x08, 0x01
+
+#
+# RIF moves are written like 'h8 i9 j10', column a-o and row 1-15 from the bottom.
+#
+_RIF_MOVE_PATTERN = re.compile('([a-o])(1[0-5]|[1-9])')
+
+
+def read_records(paths, encoding='gbk'):
+    """Yields the games found in record files one at a time, as dicts of Library attributes.
+
+    Supported formats are RenLib (.lib) files, RIF (.rif, .xml) databases, and text files (.txt) with one game per
+    line, written as RIF moves optionally preceded by tab separated black player, white player and title.
+    RenLib trees are read as one game per line, from the root to each leaf, as they are usually too large for a
+    single manual.
+    """
+    for path in paths:
+        extension = os.path.splitext(path)[1].lower()
+        try:
+            if extension == '.lib':
+                with open(path, 'rb') as file:
+                    yield from _read_renlib(file, encoding, os.path.splitext(os.path.basename(path))[0])
+            elif extension in {'.rif', '.xml'}:
+                yield from _read_rif(path)
+            elif extension == '.txt':
+                with open(path, encoding=encoding) as file:
+                    yield from _read_text(file)
+            else:
+                logging.warning('Unsupported record file {0}.'.format(path))
+        except (OSError, ValueError, SyntaxError):
+            logging.exception('Failed to read record file {0}.'.format(path))
+
+
+def format_records(games, record_format, player_names=()):
+    """Yields the lines of an export file for games given as dicts of Library attributes, see 'format_record'.
+
+    A 'rif' file starts with its players table, so 'player_names' must hold the names of the players of all games.
+    """
+    player_ids = None
+    if record_format == 'rif':
+        player_ids = {name: i + 1 for i, name in enumerate(player_names)}
+        yield '<?xml version="1.0" encoding="utf-8"?>\n<database>\n<players>\n'
+        for name, player_id in player_ids.items():
+            yield '<player id="{0}" name={1}/>\n'.format(player_id, quoteattr(name))
+        yield '</players>\n<games>\n'
+    for game in games:
+        yield format_record(game, record_format, player_ids)
+    if record_format == 'rif':
+        yield '</games>\n</database>\n'
+
+
+def format_record(game, record_format, player_ids=None):
+    """Returns one line of an export file for a game given as a dict of Library attributes.
+
+    'ndjson' lines hold every attribute including the whole manual, 'txt' and 'rif' lines hold the main line only,
+    up to the first pass move. 'txt' lines are in the format read by 'read_records'. 'rif' lines are the game
+    elements of a RIF database, referring to the players by their IDs in 'player_ids', with the title as comment.
+    """
+    if record_format == 'ndjson':
+        return '{0}\n'.format(json.dumps(game, ensure_ascii=False, separators=(',', ':')))
+    if record_format == 'txt':
+        fields = [game['blackPlayerName'], game['whitePlayerName'], game['title'], _format_rif_moves(game['manual'])]
+        return '{0}\n'.format('\t'.join(field.replace('\t', ' ').replace('\n', ' ') for field in fields))
+    if record_format == 'rif':
+        return '<game black="{0}" white="{1}"><move>{2}</move><comment>{3}</comment></game>\n'.format(
+                player_ids.get(game['blackPlayerName'], ''), player_ids.get(game['whitePlayerName'], ''),
+                _format_rif_moves(game['manual']), escape(game['title']))
+    raise ValueError('Unsupported record format {0}.'.format(record_format))
+
+
+def _read_renlib(file, encoding, title):
+    """Yields a game per line of the tree, only the moves of the current line are kept in memory.
+    """
+    header = file.read(_RENLIB_HEADER_LENGTH)
+    if len(header) < _RENLIB_HEADER_LENGTH or header[1:7] != b'RenLib':
+        raise ValueError('Not a RenLib file.')
+    root_comment, line, pending_depths, is_root, game_count = '', list(), list(), True, 0
+    while True:
+        node = file.read(2)
+        if len(node) < 2:
+            break
+        point, flags = node
+        if flags & _RENLIB_EXTENSION:
+            file.read(2)
+        comment = _read_renlib_string(file, encoding) if flags & (_RENLIB_COMMENT | _RENLIB_OLD_COMMENT) else ''
+        if is_root and point == 0:
+            # The optional move before the first one holds the comment of the manual.
+            is_root, root_comment = False, comment
+            if flags & _RENLIB_DOWN:
+                continue
+            break
+        is_root = False
+        x, y = (point & 0x0f) - 1, NUM_LINES - 1 - (point >> 4)
+        move = _new_move(x, y) if point and 0 <= x < NUM_LINES and 0 <= y < NUM_LINES else _new_move(-1, -1)
+        move['c'] = comment
+        line.append(move)
+        if flags & _RENLIB_RIGHT:
+            # The next sibling replaces this move in the line once its descendants are read.
+            pending_depths.append(len(line) - 1)
+        if flags & _RENLIB_DOWN:
+            continue
+        game_count += 1
+        yield _new_game('{0} {1}'.format(title[:33], game_count), '', '', _renlib_manual(root_comment, line))
+        if not pending_depths:
+            break
+        del line[pending_depths.pop():]
+
+
+def _renlib_manual(root_comment, line):
+    root = _new_move(-1, -1)
+    root['c'] = root_comment
+    move = root
+    for line_move in line:
+        move['d'].append(dict(line_move, d=list()))
+        move = move['d'][0]
+    return _mark_major_line(root)
+
+
+def _read_renlib_string(file, encoding):
+    raw_string = bytearray()
+    while True:
+        character = file.read(1)
+        if not character or character == b'\0':
+            break
+        raw_string.extend(character)
+    return raw_string.decode(encoding, errors='replace').replace('\b', '\n').strip()
+
+
+def _read_rif(path):
+    players, tournaments, root = dict(), dict(), None
+    for event, element in iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            continue
+        if element.tag == 'player':
+            players[element.get('id')] = ' '.join(filter(None, (element.get('name'), element.get('surname'))))
+        elif element.tag == 'tournament':
+            tournaments[element.get('id')] = element.get('name', '')
+        elif element.tag == 'game':
+            moves = _parse_rif_moves(element.findtext('move', ''))
+            title = ' '.join(filter(None, (tournaments.get(element.get('tournament')), element.get('round'))))
+            # Games without a tournament, as exported by 'format_record', are titled by their comment.
+            title = title or element.findtext('comment', '')
+            yield _new_game(title, players.get(element.get('black'), ''), players.get(element.get('white'), ''),
+                            _manual_from_moves(moves))
+            # Keep the memory flat.
+            element.clear()
+            root.clear()
+
+
+def _read_text(file):
+    for line in file:
+        fields = line.rstrip('\r\n').split('\t')
+        moves = _parse_rif_moves(fields[-1])
+        if not moves:
+            continue
+        fields = fields[:-1] + [''] * (4 - len(fields))
+        yield _new_game(fields[2], fields[0], fields[1], _manual_from_moves(moves))
+
+
+def _parse_rif_moves(text):
+    return [(ord(column) - ord('a'), int(row) - 1) for column, row in _RIF_MOVE_PATTERN.findall(text.lower())]
+
+
+def _format_rif_moves(manual):
+    moves, move = list(), manual
+    while True:
+        move = next((descendant for descendant in move['d'] if descendant['m']), None)
+        if move is None or move['x'] < 0:
+            break
+        moves.append('{0}{1}'.format(chr(ord('a') + move['x']), move['y'] + 1))
+    return ' '.join(moves)
+
+
+def _manual_from_moves(moves):
+    root = _new_move(-1, -1)
+    move = root
+    for x, y in moves:
+        move['d'].append(_new_move(x, y))
+        move = move['d'][0]
+    return _mark_major_line(root)
+
+
+def _mark_major_line(root):
+    move = root
+    while move['d']:
+        move = move['d'][0]
+        move['m'] = 1
+    return root
+
+
+def _new_move(x, y):
+    return {'x': x, 'y': y, 'm': 0, 'l': '', 'c': '', 'd': list()}
+
+
+def _new_game(title, black_player_name, white_player_name, manual):
+    manual['m'] = 1
+    return {'title': title.strip()[:40],
+            'blackPlayerName': black_player_name.strip()[:40],
+            'whitePlayerName': white_player_name.strip()[:40],
+            'manual': manual}
@@ -24,7 +24,7 @@ var STONE = {
  * Public:
  *     Renju(character, upDownReflected, leftRightReflected, rotateTimes)
  *     showFreshNew()
- *     loadLibrary(libraryId, blackPlayerName, whitePlayerName, title, manual)
+ *     loadLibrary(libraryId, blackPlayerName, whitePlayerName, title, manual, updateTime)
  *     saveLibrary()
  *     playNewMoveAt(x, y)
  *     playPassMove()
@@ -42,15 +42,28 @@ var STONE = {
  *     rotateCounterclockwise()
  *     searchText()
  *     searchManual()
+ *     searchTextAndManual()
+ *     explore()
+ *     autocomplete(htmlElement, field, dataListId)
+ *     followLibrary()
  *
  * Private:
  *     __reinitializeMoves()
+ *     __applyLiveUpdate(update)
+ *     __removeMove(move)
+ *     __recordPatch(operation)
+ *     __loadSubtree(move)
  *     __updateUi()
- *     __getSearchData(upDownReflected, leftRightReflected, rotateTimes)
+ *     __getMoves()
+ *     __showContinuations(continuations)
+ *     __hideContinuations()
  **************************************************************************************************/
 function Renju(character, upDownReflected, leftRightReflected, rotateTimes) {
     this.character = character;
     this.libraryId = '';
+    this.updateTime = 0;
+    this.patches = new Array();
+    this.patchFailed = false;
     this.upDownReflected = upDownReflected;
     this.leftRightReflected = leftRightReflected;
     this.rotateTimes = rotateTimes;
@@ -63,8 +76,10 @@ function Renju(character, upDownReflected, leftRightReflected, rotateTimes) {
     this.passHtmlElement = document.getElementById("pass");
     this.passHtmlElement.style.display = "none";
     this.rootMove = null;
+    this.liveLine = null;
     this.currentMove = null;
     this.currentBranch = null;
+    this.continuationHtmlElements = new Array();
     this.stones = new Array(NUM_LINES);
     for (var j = 0; j < NUM_LINES; j++) {
         this.stones[j] = new Array(NUM_LINES);
@@ -76,9 +91,10 @@ Renju.prototype.showFreshNew = function() {
     this.__updateUi();
 }
 
-Renju.prototype.loadLibrary = function(libraryId, title, blackPlayerName, whitePlayerName, manual) {
+Renju.prototype.loadLibrary = function(libraryId, title, blackPlayerName, whitePlayerName, manual, updateTime) {
     this.showFreshNew();
     this.libraryId = libraryId;
+    this.updateTime = updateTime;
     this.titleHtmlElement.value = title;
     this.blackPlayerNameElement.value = blackPlayerName;
     this.whitePlayerNameElement.value = whitePlayerName;
@@ -87,6 +103,9 @@ Renju.prototype.loadLibrary = function(libraryId, title, blackPlayerName, whiteP
         new Move(this.rootMove, manual[i]);
     }
     this.goToLastMove();
+    this.liveLine = this.currentBranch.slice();
+    this.patches = new Array();
+    this.patchFailed = false;
 }
 
 Renju.prototype.saveLibrary = function() {
@@ -94,27 +113,51 @@ Renju.prototype.saveLibrary = function() {
         return;
     }
     if (!this.currentMove.isRoot()) {
-        this.currentMove.label = this.labelHtmlElement.value;
-        this.currentMove.comment = this.commentHtmlElement.value;
-    }
-    var manual = JSON.stringify(this.rootMove.fillIn({}));
-    if (manual.length > 65535) {
-        alert('棋谱数据量太大!');
-        return;
+        this.currentMove.__setLabelAndComment(this.labelHtmlElement.value, this.commentHtmlElement.value);
+    }
+    var parameters = {
+        'id':this.libraryId,
+        'updateTime':this.updateTime,
+        'title':this.titleHtmlElement.value,
+        'blackPlayerName':this.blackPlayerNameElement.value,
+        'whitePlayerName':this.whitePlayerNameElement.value
+    };
+    // A saved library is sent the changes made since it was loaded or saved, rather than the whole manual.
+    // Changes are recorded from the start, those made while the request is in flight are sent by the next save.
+    var apiRequest = null;
+    var patchCount = this.patches.length;
+    var isPatch = (this.libraryId != '' && this.updateTime != 0 && !this.patchFailed);
+    if (isPatch) {
+        parameters['operations'] = JSON.stringify(this.patches);
+        apiRequest = new ApiRequest('/library/api/patch');
+    } else {
+        parameters['manual'] = JSON.stringify(this.rootMove.fillIn({}));
+        if (parameters['manual'].length > 65535) {
+            alert('棋谱数据量太大!');
+            return;
+        }
+        apiRequest = new ApiRequest('/library/api/save');
     }
-    var apiRequest = new ApiRequest('/library/api/save');
-    apiRequest.send({
-                        'id':this.libraryId,
-                        'title':this.titleHtmlElement.value,
-                        'blackPlayerName':this.blackPlayerNameElement.value,
-                        'whitePlayerName':this.whitePlayerNameElement.value,
-                        'manual':manual
-                    },
+    apiRequest.send(parameters,
                     function(result) {
+                        if (result['status'] == 6) {
+                            alert('棋谱已被他人修改, 请刷新后重新编辑');
+                            return;
+                        }
+                        if (result['status'] == 4) {
+                            // The next saves send the whole manual, in case the changes no longer apply.
+                            __renju__.patchFailed = true;
+                            alert('棋谱无效, 请检查后重新保存');
+                            return;
+                        }
                         if (result['status'] != 0) {
+                            alert('保存失败, 请稍后重试');
                             return;
                         }
                         __renju__.libraryId = result['data']['id'];
+                        __renju__.updateTime = result['data']['updateTime'];
+                        __renju__.patches.splice(0, patchCount);
+                        __renju__.patchFailed = false;
                         alert('保存成功');
                     }
     );
@@ -127,6 +170,7 @@ Renju.prototype.playNewMoveAt = function(x, y) {
     var parent = this.currentMove;
     var manual = {'x': x, 'y': y, 'm': 1, 'l':'', 'c':'', 'd':[]};
     var newMove = new Move(parent, manual);
+    this.__recordPatch({'op':'add', 'path':parent.__getPath(), 'x':x, 'y':y});
     newMove.play();
 }
 
@@ -137,6 +181,7 @@ Renju.prototype.playPassMove = function() {
 Renju.prototype.deleteCurrentMove = function() {
     if (!this.currentMove.isRoot()) {
         var toDelete = this.currentMove;
+        this.__recordPatch({'op':'delete', 'path':toDelete.__getPath()});
         this.goToPreviousMove();
         toDelete.__hide();
         var siblings = this.currentMove.descendants;
@@ -149,6 +194,7 @@ Renju.prototype.deleteCurrentMove = function() {
         delete siblings[index];
         siblings.splice(index, 1);
     } else {
+        this.__recordPatch({'op':'delete', 'path':[]});
         var descendants = this.currentMove.descendants;
         for (var i = 0; i < descendants.length; i++) {
             var descendant = descendants[i];
@@ -270,32 +316,85 @@ Renju.prototype.searchManual = function() {
     if (this.currentBranch.length <= 1) {
         return;
     }
-    var numMoves = Math.min(30, this.currentBranch.length - 1);
-    var searchDatas = new Array();
-    searchDatas.push(this.__getSearchData(false, false, 0));
-    searchDatas.push(this.__getSearchData(true, false, 1));
-    searchDatas.push(this.__getSearchData(false, false, 3));
-    searchDatas.push(this.__getSearchData(true, false, 0));
-    searchDatas.push(this.__getSearchData(true, true, 0));
-    searchDatas.push(this.__getSearchData(false, true, 1));
-    searchDatas.push(this.__getSearchData(false, false, 1));
-    searchDatas.push(this.__getSearchData(false, true, 0));
-    searchDatas.sort();
-    var last = searchDatas[0];
-    for (var i = 1; i < searchDatas.length; i++) {
-        if (last == searchDatas[i]) {
-            searchDatas.splice(i--, 1);
-        } else {
-            last = searchDatas[i];
-        }
-    }
     var formRequest = new FormRequest('/library/searchManual', 'post', '_self');
     formRequest.send({
-                         'searchDatas':JSON.stringify(searchDatas),
+                         'moves':JSON.stringify(this.__getMoves()),
+                         'cursor':''
+                     });
+}
+
+Renju.prototype.searchTextAndManual = function() {
+    if (this.titleHtmlElement.value.length == 0 && this.currentBranch.length <= 1) {
+        return;
+    }
+    var formRequest = new FormRequest('/library/searchText', 'post', '_self');
+    formRequest.send({
+                         'keyword':this.titleHtmlElement.value,
+                         'moves':JSON.stringify(this.__getMoves()),
                          'page':0
                      });
 }
 
+Renju.prototype.explore = function() {
+    var apiRequest = new ApiRequest('/library/api/explore');
+    apiRequest.send({
+                        'moves':JSON.stringify(this.__getMoves())
+                    },
+                    function(result) {
+                        if (result['status'] != 0) {
+                            return;
+                        }
+                        __renju__.__showContinuations(result['data']['continuations']);
+                    }
+    );
+}
+
+Renju.prototype.autocomplete = function(htmlElement, field, dataListId) {
+    var prefix = htmlElement.value;
+    if (prefix.length == 0) {
+        return;
+    }
+    var apiRequest = new ApiRequest('/library/api/autocomplete');
+    apiRequest.send({
+                        'field':field,
+                        'prefix':prefix
+                    },
+                    function(result) {
+                        // Ignore the names of an outdated prefix.
+                        if (result['status'] != 0 || htmlElement.value != prefix) {
+                            return;
+                        }
+                        var dataList = document.getElementById(dataListId);
+                        dataList.innerHTML = '';
+                        var names = result['data'] ? result['data']['names'] : [];
+                        for (var i = 0; i < names.length; i++) {
+                            var option = document.createElement('option');
+                            option.value = names[i];
+                            dataList.appendChild(option);
+                        }
+                    }
+    );
+}
+
+Renju.prototype.followLibrary = function() {
+    var reload = function() {
+        setTimeout(function() {
+            location.reload();
+        }, 120 * 1000);
+    };
+    if (!window.WebSocket || this.libraryId == '') {
+        reload();
+        return;
+    }
+    var scheme = (location.protocol == 'https:') ? 'wss://' : 'ws://';
+    var webSocket = new WebSocket(scheme + location.host + '/library/live?id=' + encodeURIComponent(this.libraryId));
+    webSocket.onmessage = function(event) {
+        __renju__.__applyLiveUpdate(JSON.parse(event.data));
+    };
+    // Updates may have been missed while disconnected, fall back to reloading the page.
+    webSocket.onclose = reload;
+}
+
 Renju.prototype.__reinitializeMoves = function() {
     var manual = {'x': -1, 'y': -1, 'm': 1, 'l': '', 'c': '', 'd': []};
     this.rootMove = new Move(null, manual);
@@ -309,6 +408,132 @@ Renju.prototype.__reinitializeMoves = function() {
     }
 }
 
+Renju.prototype.__applyLiveUpdate = function(update) {
+    // The variations not loaded yet keep their paths only when moves were appended to the main line.
+    if (!update['appended']) {
+        location.reload();
+        return;
+    }
+    this.updateTime = update['updateTime'];
+    this.titleHtmlElement.value = update['title'];
+    this.blackPlayerNameElement.value = update['blackPlayerName'];
+    this.whitePlayerNameElement.value = update['whitePlayerName'];
+    var isFollowing = (this.currentMove == this.liveLine[this.liveLine.length - 1]);
+    var oldLine = this.liveLine.splice(Math.min(update['keep'], this.liveLine.length - 1) + 1);
+    var moves = update['moves'];
+    var i = 0;
+    while (i < oldLine.length && i < moves.length && oldLine[i].x == moves[i]['x'] && oldLine[i].y == moves[i]['y']) {
+        oldLine[i].label = moves[i]['l'];
+        oldLine[i].comment = moves[i]['c'];
+        this.liveLine.push(oldLine[i]);
+        i++;
+    }
+    // The rest of the old main line is deleted with its variations.
+    if (i < oldLine.length) {
+        this.__removeMove(oldLine[i]);
+    }
+    for (; i < moves.length; i++) {
+        var parent = this.liveLine[this.liveLine.length - 1];
+        var move = null;
+        for (var j = 0; j < parent.descendants.length; j++) {
+            if (parent.descendants[j].x == moves[i]['x'] && parent.descendants[j].y == moves[i]['y']) {
+                move = parent.descendants[j];
+                move.label = moves[i]['l'];
+                move.comment = moves[i]['c'];
+            }
+        }
+        this.liveLine.push(move != null ? move : new Move(parent, moves[i]));
+    }
+    this.currentMove.__showAsLast();
+    if (isFollowing) {
+        for (var i = this.currentBranch.length; i < this.liveLine.length; i++) {
+            this.liveLine[i].play();
+        }
+    } else {
+        for (var i = 0; i < this.currentMove.descendants.length; i++) {
+            this.currentMove.descendants[i].__showAsVariant();
+        }
+    }
+}
+
+Renju.prototype.__removeMove = function(move) {
+    while (this.currentBranch.indexOf(move) >= 0) {
+        this.goToPreviousMove();
+    }
+    move.__hide();
+    var siblings = move.parent.descendants;
+    siblings.splice(siblings.indexOf(move), 1);
+}
+
+Renju.prototype.__recordPatch = function(operation) {
+    if (this.character == CHARACTER.EDITOR) {
+        this.patches.push(operation);
+    }
+}
+
+Renju.prototype.__loadSubtree = function(move) {
+    var apiRequest = new ApiRequest('/library/api/subtree');
+    apiRequest.send({
+                        'id':this.libraryId,
+                        'updateTime':this.updateTime,
+                        'path':JSON.stringify(move.__getPath())
+                    },
+                    function(result) {
+                        // The path may lead to another move once the library is saved.
+                        if (result['status'] == 6) {
+                            location.reload();
+                            return;
+                        }
+                        if (result['status'] != 0 || !move.isStub) {
+                            return;
+                        }
+                        var descendants = result['data']['subtree']['d'];
+                        for (var i = 0; i < descendants.length; i++) {
+                            new Move(move, descendants[i]);
+                        }
+                        move.isStub = false;
+                        if (__renju__.currentMove == move.parent) {
+                            move.play();
+                        }
+                    }
+    );
+}
+
+Renju.prototype.__getMoves = function() {
+    var moves = new Array();
+    for (var i = 1; i < this.currentBranch.length; i++) {
+        moves.push([this.currentBranch[i].x, this.currentBranch[i].y]);
+    }
+    return moves;
+}
+
+Renju.prototype.__showContinuations = function(continuations) {
+    this.__hideContinuations();
+    var descendants = this.currentMove.descendants;
+    for (var i = 0; i < continuations.length; i++) {
+        var x = continuations[i]['x'];
+        var y = continuations[i]['y'];
+        var isVariant = false;
+        for (var j = 0; j < descendants.length; j++) {
+            isVariant = isVariant || (descendants[j].x == x && descendants[j].y == y);
+        }
+        if (x < 0 || y < 0 || isVariant || this.stones[y][x] != STONE.NONE) {
+            continue;
+        }
+        var htmlElement = document.getElementById('i_' + x + '_' + y);
+        htmlElement.innerHTML = continuations[i]['count'];
+        htmlElement.style.color = '#0000ff';
+        this.continuationHtmlElements.push(htmlElement);
+    }
+}
+
+Renju.prototype.__hideContinuations = function() {
+    for (var i = 0; i < this.continuationHtmlElements.length; i++) {
+        this.continuationHtmlElements[i].innerHTML = '&nbsp;';
+    }
+    this.continuationHtmlElements = new Array();
+}
+
 Renju.prototype.__updateUi = function() {
     var boardInnerHtml = '<table class="board" background="/static/img/board.png" border="0" cellspacing="0" cellpadding="0">';
     for (var j = NUM_LINES - 1; j >= -1; j--) {
@@ -349,36 +574,6 @@ Renju.prototype.__updateUi = function() {
     }
 }
 
-Renju.prototype.__getSearchData = function(upDownReflected, leftRightReflected, rotateTimes) {
-    var part1 = new Array();
-    var part2 = new Array();
-    for (var i = 1; i < Math.min(31, this.currentBranch.length); i++) {
-    var currentBranch = this.currentBranch[i];
-        var x = currentBranch.x;
-        var y = currentBranch.y;
-        if (upDownReflected) {
-            y = NUM_LINES - 1 - y;
-        }
-        if (leftRightReflected) {
-            x = NUM_LINES - 1 - x;
-        }
-        for (var j = 0; j < rotateTimes % 4; j++) {
-            x = x ^ y;
-            y = x ^ y;
-            x = x ^ y;
-            x = NUM_LINES - 1 - x;
-        }
-        if (i % 2 == 1) {
-            part1.push('|' + x + '_' + y);
-        } else {
-            part2.push('|' + x + '_' + y);
-        }
-    }
-    part1.sort();
-    part2.sort();
-    return part1.join('') + part2.join('');
-}
-
 
 /***************************************************************************************************
  *
@@ -400,6 +595,8 @@ Renju.prototype.__getSearchData = function(upDownReflected, leftRightReflected,
  *     __showAsLast()
  *     __showAsVariant()
  *     __hide()
+ *     __setLabelAndComment(label, comment)
+ *     __getPath()
  *     __isPass()
  *     __getHtmlElement()
  **************************************************************************************************/
@@ -412,6 +609,8 @@ function Move(parent, manual) {
     this.isMajor = (manual['m'] == 1);
     this.label = manual['l'];
     this.comment = manual['c'];
+    // The descendants of a stub are loaded when it is played.
+    this.isStub = (manual['s'] == 1);
     manual = manual['d'];
     this.descendants = new Array();
     for (var i = 0; i < manual.length; i++) {
@@ -436,6 +635,11 @@ Move.prototype.fillIn = function(manual) {
 }
 
 Move.prototype.play = function() {
+    if (this.isStub) {
+        __renju__.__loadSubtree(this);
+        return;
+    }
+    __renju__.__hideContinuations();
     __renju__.currentBranch.push(this);
     if (!this.__isPass()) {
         __renju__.stones[this.y][this.x] = this.stone;
@@ -445,9 +649,10 @@ Move.prototype.play = function() {
         setTimeout('__renju__.passHtmlElement.style.display="none"', 1000);
     }
     __renju__.currentMove = this;
-    var parent = this.parent;
-    parent.label = __renju__.labelHtmlElement.value;
-    parent.comment = __renju__.commentHtmlElement.value;
+    this.parent.__setLabelAndComment(__renju__.labelHtmlElement.value, __renju__.commentHtmlElement.value);
+    if (!this.isMajor) {
+        __renju__.__recordPatch({'op':'select', 'path':this.__getPath()});
+    }
     this.__play();
 }
 
@@ -459,8 +664,8 @@ Move.prototype.recall = function() {
     if (this.isRoot()) {
         return;
     }
-    this.label = __renju__.labelHtmlElement.value;
-    this.comment = __renju__.commentHtmlElement.value;
+    __renju__.__hideContinuations();
+    this.__setLabelAndComment(__renju__.labelHtmlElement.value, __renju__.commentHtmlElement.value);
     __renju__.currentBranch.pop();
     __renju__.currentMove = this.parent;
     if (!this.__isPass()) {
@@ -578,6 +783,23 @@ Move.prototype.__hide = function() {
     };
 }
 
+Move.prototype.__setLabelAndComment = function(label, comment) {
+    if (label == this.label && comment == this.comment) {
+        return;
+    }
+    this.label = label;
+    this.comment = comment;
+    __renju__.__recordPatch({'op':'set', 'path':this.__getPath(), 'l':label, 'c':comment});
+}
+
+Move.prototype.__getPath = function() {
+    var path = new Array();
+    for (var move = this; !move.isRoot(); move = move.parent) {
+        path.unshift(move.parent.descendants.indexOf(move));
+    }
+    return path;
+}
+
 Move.prototype.__isPass = function() {
     return this.x < 0 || this.y < 0;
 }
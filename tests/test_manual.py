@@ -0,0 +1,159 @@
+import unittest
+
+from library.manual import NUM_LINES, PASS_POINT, MAX_DEPTH, InvalidManual, walk_manual, unpack_manual, main_line, \
+    apply_patch, trim_manual, subtree, position_hashes, canonical_position, untransform_point, transform_point
+
+
+def _move(x, y, m=0, l='', c='', d=None):
+    return {'x': x, 'y': y, 'm': m, 'l': l, 'c': c, 'd': d or list()}
+
+
+def _line(*points):
+    root = move = _move(-1, -1, 1)
+    for x, y in points:
+        move['d'].append(_move(x, y, 1))
+        move = move['d'][0]
+    return root
+
+
+def _walk(manual, max_nodes=10000, max_patterns=10000):
+    return walk_manual(manual, max_nodes, max_patterns)
+
+
+class WalkManualTest(unittest.TestCase):
+    def test_pack_round_trip(self):
+        manual = _move(-1, -1, 1, c='Root comment.', d=[
+            _move(7, 7, 1, l='A', d=[
+                _move(8, 8, 1, c='Main line.', d=[_move(-1, -1, 1, d=[_move(9, 9, 1)])]),
+                _move(6, 8, 0, l='B', c='Variant.', d=[_move(6, 6)]),
+                _move(0, 14)]),
+            _move(14, 0)])
+        summary = _walk(manual)
+        self.assertEqual(summary.node_count, 9)
+        self.assertEqual(summary.depth, 4)
+        self.assertEqual(summary.labels, ['A', 'B'])
+        self.assertEqual(summary.comments, ['Root comment.', 'Main line.', 'Variant.'])
+        self.assertEqual(len(summary.packed_manual), 2 * summary.node_count)
+        self.assertEqual(summary.packed_manual[0], PASS_POINT)
+        self.assertEqual(unpack_manual(summary.packed_manual, summary.labels, summary.comments), manual)
+
+    def test_transposition_kept_once(self):
+        manual = _move(-1, -1, 1, d=[
+            _move(7, 7, 1, d=[_move(8, 8, 1, d=[_move(9, 9, 1)])]),
+            _move(9, 9, 0, d=[_move(8, 8, 0, d=[_move(7, 7, 0)])])])
+        summary = _walk(manual)
+        self.assertEqual(len(summary.patterns), len(set(summary.patterns)))
+        self.assertEqual(summary.patterns[-1], position_hashes([(7, 7), (8, 8), (9, 9)])[-1])
+        self.assertEqual(len(summary.patterns), 5)
+
+    def test_max_patterns_keeps_shallowest(self):
+        summary = _walk(_line((7, 7), (8, 8), (9, 9), (10, 10)), max_patterns=2)
+        self.assertEqual(summary.patterns, position_hashes([(7, 7), (8, 8)]))
+
+    def test_too_many_moves(self):
+        with self.assertRaises(InvalidManual):
+            _walk(_line((7, 7), (8, 8), (9, 9)), max_nodes=3)
+
+    def test_occupied_point(self):
+        with self.assertRaisesRegex(InvalidManual, 'Occupied'):
+            _walk(_line((7, 7), (8, 8), (7, 7)))
+
+    def test_same_point_in_other_line(self):
+        manual = _move(-1, -1, 1, d=[_move(7, 7, 1, d=[_move(8, 8, 1)]), _move(8, 8, 0, d=[_move(7, 7)])])
+        self.assertEqual(_walk(manual).node_count, 5)
+
+    def test_too_long_line(self):
+        root = move = _move(-1, -1, 1)
+        for _ in range(MAX_DEPTH + 1):
+            move['d'].append(_move(-1, -1, 1))
+            move = move['d'][0]
+        with self.assertRaisesRegex(InvalidManual, 'Too long'):
+            _walk(root)
+
+    def test_invalid_moves(self):
+        for manual in (None,
+                       _move(7, 7, 1),
+                       _line((NUM_LINES, 0)),
+                       _line((0, -1)),
+                       _line(('7', 7)),
+                       _move(-1, -1, 2),
+                       _move(-1, -1, 1, l=1),
+                       {'x': -1, 'y': -1, 'm': 1, 'd': list()},
+                       _move(-1, -1, 1, d={'x': 7})):
+            with self.assertRaises(InvalidManual):
+                _walk(manual)
+
+
+class PositionTest(unittest.TestCase):
+    moves = [(7, 7), (8, 7), (8, 9), (5, 6), (10, 3)]
+
+    def test_symmetric_positions_share_hashes(self):
+        hashes = position_hashes(self.moves)
+        self.assertEqual(len(set(hashes)), len(hashes))
+        for transform in range(8):
+            self.assertEqual(position_hashes([transform_point(x, y, transform) for x, y in self.moves]), hashes)
+
+    def test_pass_moves_switch_stones(self):
+        self.assertNotEqual(position_hashes([(7, 7), (-1, -1), (8, 8)])[-1], position_hashes([(7, 7), (8, 8)])[-1])
+
+    def test_canonical_point_round_trip(self):
+        next_x, next_y = 11, 2
+        for transform in range(8):
+            moves = [transform_point(x, y, transform) for x, y in self.moves]
+            summary = _walk(_line(*(moves + [transform_point(next_x, next_y, transform)])))
+            pattern, position_transform = canonical_position(moves)
+            self.assertEqual(pattern, position_hashes(moves)[-1])
+            points = [point for opening_pattern, point in summary.openings if opening_pattern == pattern]
+            self.assertEqual(len(points), 1)
+            self.assertEqual(untransform_point(points[0], position_transform),
+                             transform_point(next_x, next_y, transform))
+
+    def test_symmetric_position_canonical_point(self):
+        # Both diagonal neighbours of the center lead to the same position, and are recorded as the same point.
+        first = _walk(_line((7, 7), (8, 8)))
+        second = _walk(_line((7, 7), (6, 6)))
+        self.assertEqual(first.openings, second.openings)
+        self.assertEqual(untransform_point(PASS_POINT, 3), (-1, -1))
+
+
+class PatchTest(unittest.TestCase):
+    def test_add_select_delete_set(self):
+        manual = _line((7, 7), (8, 8))
+        apply_patch(manual, [{'op': 'add', 'path': [0], 'x': 6, 'y': 8}])
+        self.assertEqual([(move['x'], move['y']) for move in main_line(manual)], [(7, 7), (6, 8)])
+        self.assertEqual(manual['d'][0]['d'][0]['m'], 0)
+        apply_patch(manual, [{'op': 'select', 'path': [0, 0]},
+                             {'op': 'set', 'path': [0, 0], 'l': 'A', 'c': 'Comment.'},
+                             {'op': 'delete', 'path': [0, 1]}])
+        self.assertEqual([(move['x'], move['y']) for move in main_line(manual)], [(7, 7), (8, 8)])
+        self.assertEqual(len(manual['d'][0]['d']), 1)
+        self.assertEqual((manual['d'][0]['d'][0]['l'], manual['d'][0]['d'][0]['c']), ('A', 'Comment.'))
+        apply_patch(manual, [{'op': 'delete', 'path': []}])
+        self.assertEqual(manual['d'], list())
+
+    def test_invalid_operations(self):
+        for operations in ({'op': 'delete', 'path': []},
+                           [{'op': 'move', 'path': []}],
+                           [{'op': 'select'}],
+                           [{'op': 'select', 'path': [1]}],
+                           [{'op': 'select', 'path': [-1]}],
+                           [{'op': 'select', 'path': ['0']}],
+                           [{'op': 'select', 'path': 0}],
+                           [{'op': 'add', 'path': [0]}]):
+            with self.assertRaises(InvalidManual):
+                apply_patch(_line((7, 7)), operations)
+
+    def test_trim_and_subtree(self):
+        manual = _move(-1, -1, 1, d=[
+            _move(7, 7, 0, d=[_move(6, 6)]),
+            _move(8, 8, 1, d=[_move(9, 9, 1, d=[_move(10, 10, 1)]), _move(6, 8)])])
+        trimmed = trim_manual(manual)
+        self.assertNotIn('s', trimmed)
+        self.assertEqual(trimmed['d'][0], {'x': 7, 'y': 7, 'm': 0, 'l': '', 'c': '', 'd': list(), 's': 1})
+        self.assertEqual(main_line(trimmed), main_line(manual))
+        self.assertNotIn('s', trimmed['d'][1]['d'][1])
+        self.assertEqual(subtree(manual, [0]), {'x': 7, 'y': 7, 'm': 0, 'l': '', 'c': '',
+                                                'd': [_move(6, 6)]})
+        for path in ([2], [0, 0, 0], None, ['a']):
+            with self.assertRaises(InvalidManual):
+                subtree(manual, path)
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from bson import ObjectId
+from tornado.options import options, define
+
+if 'library_position_index_path' not in options:
+    define('library_position_index_path', default='')
+
+from library import position_index
+from library.position_index import _PositionIndex, build
+
+
+class PositionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'position_index')
+        self.ids = [ObjectId() for _ in range(6)]
+        # (library ID, update time, patterns), two libraries share an update time.
+        self.libraries = [(self.ids[0], 100, [1, 2]),
+                          (self.ids[1], 300, [1]),
+                          (self.ids[2], 200, [1, -5]),
+                          (self.ids[3], 200, [1, 2]),
+                          (self.ids[4], 50, [2])]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _index(self):
+        build(self.path, self.libraries)
+        return _PositionIndex(self.path)
+
+    def _expected(self, pattern):
+        return sorted(((update_time, library_id) for library_id, update_time, patterns in self.libraries
+                       if pattern in patterns), key=lambda record: (record[0], record[1].binary), reverse=True)
+
+    def test_missing_file(self):
+        index = _PositionIndex(self.path)
+        self.assertIsNone(index.count(1))
+        self.assertIsNone(index.lookup(1, 10))
+
+    def test_lookup(self):
+        index = self._index()
+        for pattern in (1, 2, -5):
+            self.assertEqual(index.lookup(pattern, 10), self._expected(pattern))
+            self.assertEqual(index.count(pattern), len(self._expected(pattern)))
+        self.assertEqual(index.lookup(3, 10), list())
+        self.assertEqual(index.count(0), 0)
+
+    def test_keyset_paging(self):
+        index = self._index()
+        records, after = list(), None
+        while True:
+            page = index.lookup(1, 1, after)
+            if not page:
+                break
+            records.extend(page)
+            after = page[-1]
+        self.assertEqual(records, self._expected(1))
+
+    def test_build_in_runs(self):
+        with mock.patch.object(position_index, '_BUILD_RUN_SIZE', 2):
+            index = self._index()
+        self.assertEqual(os.listdir(self.directory), ['position_index'])
+        for pattern in (1, 2, -5):
+            self.assertEqual(index.lookup(pattern, 10), self._expected(pattern))
+
+    def test_delta_merge(self):
+        index = self._index()
+        # Changes made after the file is mapped are newer than the file.
+        index.count(1)
+        now = index.build_time + 1
+        index.record_saved(self.ids[5], now, [1], [])
+        index.record_saved(self.ids[1], now + 1, [2], [1])
+        index.record_deleted(self.ids[2], [1, -5])
+        expected = [(now, self.ids[5]), (200, self.ids[3]), (100, self.ids[0])]
+        self.assertEqual(index.lookup(1, 10), expected)
+        self.assertEqual(index.count(1), 3)
+        self.assertEqual(index.lookup(2, 10)[0], (now + 1, self.ids[1]))
+        self.assertEqual(index.count(2), 4)
+        self.assertEqual(index.count(-5), 0)
+        self.assertEqual(index.lookup(1, 1, expected[0]), expected[1:2])
+        self.assertEqual(index.lookup(1, 10, expected[1]), expected[2:])
+
+    def test_delta_keeps_patterns_of_file(self):
+        index = self._index()
+        # Changes made after the file is mapped are newer than the file.
+        index.count(1)
+        now = index.build_time + 1
+        index.record_saved(self.ids[0], now, [1, 2, 3], [1, 2])
+        index.record_saved(self.ids[0], now + 1, [3], [])
+        self.assertEqual(index.count(1), 3)
+        self.assertEqual(index.count(3), 1)
+        self.assertNotIn(self.ids[0], [library_id for _, library_id in index.lookup(2, 10)])
+
+    def test_delta_overflow(self):
+        index = self._index()
+        self.assertEqual(index.count(1), 4)
+        now = index.build_time + 1
+        with mock.patch.object(position_index, '_MAX_DELTA_SIZE', 1), \
+                mock.patch.object(position_index, '_now', return_value=now):
+            index.record_saved(self.ids[5], now, [1], [])
+            index.record_saved(self.ids[4], now, [1], [2])
+        self.assertIsNone(index.count(1))
+        self.assertIsNone(index.lookup(1, 10))
+        # A file built later is used again.
+        with mock.patch.object(position_index, '_now', return_value=now + 1):
+            build(self.path, self.libraries)
+        index.checked_at = 0
+        self.assertEqual(index.lookup(1, 10), self._expected(1))
@@ -0,0 +1,123 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from library.manual import main_line
+from library.records import read_records, format_records, format_record
+
+
+def _points(manual):
+    return [(move['x'], move['y']) for move in main_line(manual)]
+
+
+class ReadRecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as file:
+            file.write(content)
+        return path
+
+    def test_renlib(self):
+        header = b'\xffRenLib\x03\x00' + b'\x00' * 11
+        nodes = (b'\x00\x88' + 'Opening'.encode('gbk') + b'\x00' +  # Root comment.
+                 b'\x78\x80' +  # h8, down.
+                 b'\x69\x48' + '变化'.encode('gbk') + b'\x00' +  # i9, right, comment.
+                 b'\x5a\x01\x00\x00')  # j10, extension, end.
+        games = list(read_records([self._write('Sample.lib', header + nodes)]))
+        self.assertEqual([game['title'] for game in games], ['Sample 1', 'Sample 2'])
+        self.assertEqual([game['manual']['c'] for game in games], ['Opening', 'Opening'])
+        self.assertEqual([_points(game['manual']) for game in games], [[(7, 7), (8, 8)], [(7, 7), (9, 9)]])
+        self.assertEqual([main_line(game['manual'])[-1]['c'] for game in games], ['变化', ''])
+
+    def test_renlib_nested_variants(self):
+        header = b'\xffRenLib\x03\x00' + b'\x00' * 11
+        # h8 (h9 (i9, j9), i8), the last move of each line has no down flag.
+        nodes = b'\x78\x80' + b'\x68\xc0' + b'\x69\x40' + b'\x6a\x00' + b'\x79\x00'
+        games = list(read_records([self._write('Tree.lib', header + nodes)]))
+        self.assertEqual([_points(game['manual']) for game in games],
+                         [[(7, 7), (7, 8), (8, 8)], [(7, 7), (7, 8), (9, 8)], [(7, 7), (8, 7)]])
+
+    def test_not_renlib(self):
+        self.assertEqual(list(read_records([self._write('Sample.lib', b'\x00' * 40)])), list())
+
+    def test_rif(self):
+        content = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<database><players><player id="1" name="Ann" surname="Black"/><player id="2" name="Bo"/>'
+                   '</players><tournaments><tournament id="7" name="Cup"/></tournaments>'
+                   '<games><game id="1" black="1" white="2" tournament="7" round="3"><move>h8 i9 J10</move></game>'
+                   '<game id="2" black="2" white="9"><move>h8 h9 h10 h11 o15</move></game></games></database>')
+        games = list(read_records([self._write('database.rif', content.encode('utf-8'))]))
+        self.assertEqual([(game['title'], game['blackPlayerName'], game['whitePlayerName']) for game in games],
+                         [('Cup 3', 'Ann Black', 'Bo'), ('', 'Bo', '')])
+        self.assertEqual(_points(games[0]['manual']), [(7, 7), (8, 8), (9, 9)])
+        self.assertEqual(_points(games[1]['manual'])[-1], (14, 14))
+
+    def test_text(self):
+        content = 'Ann\tBo\tFinal\th8 i9 j10\r\n\nh8 h9\nnot a game\n'
+        games = list(read_records([self._write('games.txt', content.encode('gbk'))]))
+        self.assertEqual([(game['title'], game['blackPlayerName'], game['whitePlayerName']) for game in games],
+                         [('Final', 'Ann', 'Bo'), ('', '', '')])
+        self.assertEqual(_points(games[1]['manual']), [(7, 7), (7, 8)])
+        self.assertEqual(games[0]['manual']['m'], 1)
+
+    def test_unsupported(self):
+        self.assertEqual(list(read_records([self._write('games.pdf', b''),
+                                            os.path.join(self.directory, 'missing.txt')])), list())
+
+
+class FormatRecordTest(unittest.TestCase):
+    game = {'title': 'Final', 'blackPlayerName': 'Ann\tA', 'whitePlayerName': '博',
+            'manual': {'x': -1, 'y': -1, 'm': 1, 'l': '', 'c': '', 'd': [
+                {'x': 7, 'y': 7, 'm': 1, 'l': '', 'c': '', 'd': [
+                    {'x': 14, 'y': 14, 'm': 0, 'l': '', 'c': '', 'd': list()},
+                    {'x': 8, 'y': 9, 'm': 1, 'l': '', 'c': '', 'd': [
+                        {'x': -1, 'y': -1, 'm': 1, 'l': '', 'c': '', 'd': [
+                            {'x': 0, 'y': 0, 'm': 1, 'l': '', 'c': '', 'd': list()}]}]}]}]}}
+
+    def test_ndjson(self):
+        line = format_record(self.game, 'ndjson')
+        self.assertTrue(line.endswith('\n'))
+        self.assertEqual(json.loads(line), self.game)
+
+    def test_txt_round_trip(self):
+        line = format_record(self.game, 'txt')
+        self.assertEqual(line, 'Ann A\t博\tFinal\th8 i10\n')
+        path = os.path.join(tempfile.mkdtemp(), 'games.txt')
+        try:
+            with open(path, 'w', encoding='gbk') as file:
+                file.write(line)
+            game, = read_records([path])
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+        self.assertEqual((game['blackPlayerName'], game['whitePlayerName'], game['title']), ('Ann A', '博', 'Final'))
+        self.assertEqual(_points(game['manual']), [(7, 7), (8, 9)])
+
+    def test_rif_round_trip(self):
+        games = [self.game, dict(self.game, title='<A & B>', blackPlayerName='', whitePlayerName='Ann\tA')]
+        content = ''.join(format_records(games, 'rif', ['Ann\tA', '博']))
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'games.rif')
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(content)
+            read_games = list(read_records([path]))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([(game['title'], game['blackPlayerName'], game['whitePlayerName']) for game in read_games],
+                         [('Final', 'Ann\tA', '博'), ('<A & B>', '', 'Ann\tA')])
+        self.assertEqual([_points(game['manual']) for game in read_games], [[(7, 7), (8, 9)]] * 2)
+
+    def test_format_records(self):
+        self.assertEqual(list(format_records([self.game], 'txt')), [format_record(self.game, 'txt')])
+
+    def test_unsupported_format(self):
+        with self.assertRaises(ValueError):
+            format_record(self.game, 'pdf')
@@ -0,0 +1,134 @@
+import json
+import hmac
+import hashlib
+import unittest
+from unittest import mock
+
+from tornado.options import options, define
+
+for name, default in (('redis_session_db_host', '127.0.0.1'), ('redis_session_db_port', 6379),
+                      ('redis_session_db_database', 2), ('redis_session_db_timeout', 0.1),
+                      ('session_expire_after', 30 * 24 * 60 * 60), ('session_backend', 'redis'),
+                      ('session_secret', ''), ('session_revocation_refresh_interval', 10)):
+    if name not in options:
+        define(name, default=default)
+
+from core import sessions
+from core.sessions import SignedSessionBackend, _b64encode
+
+_SECRET = 'x' * 32
+
+
+def _payload(session_id):
+    payload = session_id.partition('.')[0]
+    return json.loads(sessions.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+
+
+def _sign(payload, secret=_SECRET):
+    return _b64encode(hmac.new(secret.encode('utf-8'), payload.encode('utf-8'), hashlib.sha256).digest())
+
+
+class _FakeRedis:
+    """The sorted set commands used for the revoked sessions, shared by all clients like a Redis server.
+    """
+    sorted_sets = dict()
+
+    def __init__(self, **kwargs):
+        pass
+
+    def zadd(self, name, score, member):
+        _FakeRedis.sorted_sets.setdefault(name, dict())[member] = score
+
+    def zremrangebyscore(self, name, min, max):
+        members = _FakeRedis.sorted_sets.get(name, dict())
+        for member in [member for member, score in members.items() if score <= float(max)]:
+            del members[member]
+
+    def zrangebyscore(self, name, min, max):
+        return [member for member, score in _FakeRedis.sorted_sets.get(name, dict()).items() if score >= float(min)]
+
+
+class SignedSessionBackendTest(unittest.TestCase):
+    session_data = {'userId': 'user', 'permissions': ['normal']}
+
+    def setUp(self):
+        _FakeRedis.sorted_sets.clear()
+        patcher = mock.patch.object(sessions.redis, 'StrictRedis', _FakeRedis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = SignedSessionBackend(_SECRET, 10)
+
+    def test_round_trip(self):
+        session_id = self.backend.generate(self.session_data)
+        self.assertEqual(self.backend.get(session_id), self.session_data)
+        self.assertEqual(SignedSessionBackend(_SECRET, 10).get(session_id), self.session_data)
+        self.assertNotEqual(self.backend.generate(self.session_data), session_id)
+        self.assertFalse(self.backend.set(session_id, {'userId': 'user', 'permissions': ['root']}))
+
+    def test_forged_payload(self):
+        session_id = self.backend.generate(self.session_data)
+        payload = dict(_payload(session_id), permissions=['root'])
+        forged_payload = _b64encode(json.dumps(payload).encode('utf-8'))
+        self.assertIsNone(self.backend.get('{0}.{1}'.format(forged_payload, session_id.partition('.')[2])))
+        self.assertIsNone(self.backend.get('{0}.{1}'.format(forged_payload, _sign(forged_payload, 'y' * 32))))
+        # Only the secret can sign a payload.
+        self.assertEqual(self.backend.get('{0}.{1}'.format(forged_payload, _sign(forged_payload)))['permissions'],
+                         ['root'])
+
+    def test_invalid_signature(self):
+        session_id = self.backend.generate(self.session_data)
+        payload, _, signature = session_id.partition('.')
+        tampered_signature = ('A' if signature[0] != 'A' else 'B') + signature[1:]
+        for invalid_session_id in ('{0}.{1}'.format(payload, tampered_signature), payload, '{0}.'.format(payload),
+                                   '', '.', 'invalid'):
+            self.assertIsNone(self.backend.get(invalid_session_id))
+        self.assertIsNone(SignedSessionBackend('y' * 32, 10).get(session_id))
+
+    def test_invalid_signed_payload(self):
+        for payload in ('not json', _b64encode(b'not json')):
+            self.assertIsNone(self.backend.get('{0}.{1}'.format(payload, _sign(payload))))
+
+    def test_expired(self):
+        session_id = self.backend.generate(self.session_data)
+        expired_at = _payload(session_id)['exp']
+        with mock.patch.object(sessions.time, 'time', return_value=expired_at + 1):
+            self.assertIsNone(self.backend.get(session_id))
+        with mock.patch.object(sessions.time, 'time', return_value=expired_at - 1):
+            self.assertEqual(self.backend.get(session_id), self.session_data)
+
+    def test_revoked(self):
+        other_backend = SignedSessionBackend(_SECRET, 10)
+        session_id, other_session_id = self.backend.generate(self.session_data), self.backend.generate({})
+        self.assertEqual(other_backend.get(session_id), self.session_data)
+        self.backend.invalidate(session_id)
+        self.assertIsNone(self.backend.get(session_id))
+        self.assertEqual(self.backend.get(other_session_id), {})
+        # Other processes trust the session until they refresh the revoked sessions.
+        self.assertEqual(other_backend.get(session_id), self.session_data)
+        other_backend.refreshed_at = 0
+        self.assertIsNone(other_backend.get(session_id))
+        self.assertIsNone(SignedSessionBackend(_SECRET, 10).get(session_id))
+
+    def test_invalidate_invalid_session(self):
+        self.backend.invalidate('invalid')
+        self.assertEqual(_FakeRedis.sorted_sets, dict())
+
+
+class CreateSessionBackendTest(unittest.TestCase):
+    def setUp(self):
+        backend, secret = options.session_backend, options.session_secret
+        self.addCleanup(setattr, options, 'session_backend', backend)
+        self.addCleanup(setattr, options, 'session_secret', secret)
+        options.session_backend = 'signed'
+
+    def test_short_secret(self):
+        for secret in ('', 'x' * 31):
+            options.session_secret = secret
+            with self.assertRaises(Exception):
+                sessions._create_session_backend()
+
+    def test_secret(self):
+        options.session_secret = _SECRET
+        self.assertIsInstance(sessions._create_session_backend(), SignedSessionBackend)
+        options.session_backend = 'redis'
+        self.assertIsInstance(sessions._create_session_backend(), sessions.RedisSessionBackend)